@@ -25,6 +25,7 @@ from dateutil.parser import parse as parse_date
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 
 def _debug_set(key: str, value):
     st.session_state.setdefault("_debug", {})
@@ -74,15 +75,32 @@ def _download_button_csv(df: pd.DataFrame, label: str, filename: str):
     csv_bytes = df.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
     st.download_button(label, data=csv_bytes, file_name=filename, mime="text/csv")
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def _xlsx_bytes(sheets: dict[str, pd.DataFrame]) -> bytes:
+    """Gera um XLSX (uma aba por item de `sheets`) com largura de coluna ajustada."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        for sheet_name, df_sheet in sheets.items():
+            df_sheet.to_excel(writer, index=False, sheet_name=sheet_name)
+            ws = writer.sheets[sheet_name]
+            col_max = (
+                df_sheet.astype(str).apply(lambda s: s.str.len().max())
+                .reindex(df_sheet.columns).fillna(0).to_numpy()
+            )
+            header_len = np.array([len(str(c)) for c in df_sheet.columns])
+            widths = np.minimum(np.maximum(col_max, header_len) + 2, 40)
+            for i, w in enumerate(widths):
+                ws.set_column(i, i, int(w))
+    return buffer.getvalue()
+
 def _kpi_block(label, value, help_text=None):
     st.metric(label=label, value=value, help=help_text)
 
-def _hhmm_to_minutes(hhmm):
-    try:
-        h, m = str(hhmm)[:5].split(":")
-        return int(h) * 60 + int(m)
-    except Exception:
-        return 0
+def _hhmm_to_minutes(hhmm: pd.Series) -> pd.Series:
+    """'HH:MM' (ou 'HH:MM:SS') -> minutos desde 00:00, vetorizado; inválido vira 0."""
+    parts = hhmm.astype("string").str.slice(0, 5).str.extract(r"^\s*(\d+)\s*:\s*(\d+)\s*$")
+    mins = pd.to_numeric(parts[0], errors="coerce") * 60 + pd.to_numeric(parts[1], errors="coerce")
+    return mins.fillna(0).astype("int16")
 
 def _find_latest_slots_csv():
     pattern = os.path.join(DATA_DIR, "slots_*.csv")
@@ -489,7 +507,7 @@ def _ensure_base_columns(df: pd.DataFrame) -> pd.DataFrame:
     df["Horario"] = df["Horario"].apply(_to_hhmm)
 
     for col in ["Capacidade", "Disponíveis", "Bookados"]:
-        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype(int)
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype("int32")
 
     def _infer_period(hhmm):
         if not hhmm or not isinstance(hhmm, str) or ":" not in hhmm:
@@ -516,7 +534,7 @@ def _ensure_base_columns(df: pd.DataFrame) -> pd.DataFrame:
 
     if "Ocupacao%" not in df.columns:
         df["Ocupacao%"] = (df["Bookados"] / df["Capacidade"] * 100)
-        df["Ocupacao%"] = df["Ocupacao%"].replace([np.inf, -np.inf], np.nan).fillna(0).round(1)
+        df["Ocupacao%"] = df["Ocupacao%"].replace([np.inf, -np.inf], np.nan).fillna(0).round(1).astype("float32")
 
     if "Professor" not in df.columns:
         df["Professor"] = None
@@ -533,13 +551,70 @@ def _ensure_base_columns(df: pd.DataFrame) -> pd.DataFrame:
     if "Pista" not in df.columns:
         df["Pista"] = None
 
-    return df
+    # chave numérica de ordenação do horário
+    df["HorarioMin"] = _hhmm_to_minutes(df["Horario"])
+
+    # colunas de baixa cardinalidade: groupby/isin trabalham sobre os códigos
+    for col in ["Atividade", "Periodo", "Professor", "Pista"]:
+        df[col] = df[col].astype("category")
+
+    return _sort_by_date(df)
 
-def _load_data() -> pd.DataFrame:
+def _sort_by_date(df: pd.DataFrame) -> pd.DataFrame:
+    """Ordena por Data/HorarioMin (datas inválidas no fim) para o filtro de período fatiar por busca binária."""
+    return df.sort_values(["Data", "HorarioMin"], kind="mergesort", na_position="last", ignore_index=True)
+
+def _parquet_shard_path(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+# falhas de conversão do Arrow (ArrowInvalid/TypeError/NotImplemented herdam
+# de ValueError/TypeError/NotImplementedError), de IO, ou pyarrow ausente
+_PARQUET_ERRORS = (ImportError, OSError, ValueError, TypeError, NotImplementedError)
+
+def _write_parquet_shard(df_norm: pd.DataFrame, csv_path: str) -> None:
+    shard = _parquet_shard_path(csv_path)
+    try:
+        df_norm.to_parquet(shard, compression="zstd", index=False)
+    except _PARQUET_ERRORS:
+        # colunas com tipos mistos não viram parquet; o CSV continua sendo a fonte.
+        # Não deixa um .parquet pela metade para o próximo _load_data.
+        try:
+            os.remove(shard)
+        except FileNotFoundError:
+            pass
+
+def _scan_sources() -> tuple:
+    """Chave de cache do CSV de slots mais recente: ((path, mtime_ns, size),)."""
     latest = _find_latest_slots_csv()
     if not latest:
+        return ()
+    stt = os.stat(latest)
+    return ((latest, stt.st_mtime_ns, stt.st_size),)
+
+@st.cache_data(show_spinner=False, ttl=300)
+def _load_data(scan_key: tuple) -> pd.DataFrame:
+    """
+    Lê o CSV de slots mais recente já normalizado.
+    O resultado fica em memória (st.cache_data) e em disco, num `slots_*.parquet`
+    irmão do CSV, que só é regenerado quando o CSV de origem muda.
+    """
+    if not scan_key:
         return pd.DataFrame()
-    return _ensure_base_columns(_read_csv_safely(latest))
+    path, mtime_ns, _size = scan_key[0]
+    cache_path = _parquet_shard_path(path)
+
+    if os.path.exists(cache_path) and os.stat(cache_path).st_mtime_ns >= mtime_ns:
+        try:
+            df_cached = pd.read_parquet(cache_path)
+            if "HorarioMin" in df_cached.columns:
+                return _sort_by_date(df_cached)
+        except _PARQUET_ERRORS:
+            # shard ilegível: refaz a partir do CSV abaixo
+            pass
+
+    df = _ensure_base_columns(_read_csv_safely(path))
+    _write_parquet_shard(df, path)
+    return df
 
 # ──────────────────────────────────────────────────────────────────────────────
 # COLETOR EVO (EMBUTIDO)
@@ -867,17 +942,25 @@ def _extract_alunos(detail: dict, target_start: str | None = None, slot_date: st
             return None
         return {"name": n, "idCliente": _id(o)}
 
-    for sess_key in ["sessions", "classes", "scheduleItems"]:
-        sess_list = detail.get(sess_key)
+    # só as chaves que existem de fato no detail (evita sondar todas por item)
+    present_sessions = [k for k in ("sessions", "classes", "scheduleItems") if k in detail]
+    present_lists = [k for k in list_keys if k in detail]
+    if not present_sessions and not present_lists:
+        return []
+
+    for sess_key in present_sessions:
+        sess_list = detail[sess_key]
         if isinstance(sess_list, list) and sess_list:
             for sess in sess_list:
                 if not isinstance(sess, dict):
                     continue
-                sess_start = str(_first(sess, "startTime", "hourStart", "timeStart", "startHour") or "").strip()
+                sess_start = str(
+                    sess.get("startTime") or sess.get("hourStart") or sess.get("timeStart") or sess.get("startHour") or ""
+                ).strip()
                 if target_start and sess_start and target_start != sess_start:
                     continue
-                for lk in list_keys:
-                    lst = sess.get(lk)
+                for lk in [k for k in list_keys if k in sess]:
+                    lst = sess[lk]
                     if isinstance(lst, list) and lst:
                         packed = []
                         for it in lst:
@@ -887,11 +970,14 @@ def _extract_alunos(detail: dict, target_start: str | None = None, slot_date: st
                         return packed
 
     packed = []
-    for lk in list_keys:
-        lst = detail.get(lk)
+    for lk in present_lists:
+        lst = detail[lk]
         if isinstance(lst, list):
             for it in lst:
-                item_start = str(_first(it, "startTime", "hourStart", "timeStart") or "").strip()
+                if isinstance(it, dict):
+                    item_start = str(it.get("startTime") or it.get("hourStart") or it.get("timeStart") or "").strip()
+                else:
+                    item_start = ""
                 if item_start and target_start and item_start != target_start:
                     continue
                 rec = _pack(it)
@@ -1096,16 +1182,19 @@ def _materialize_rows(atividades, agenda_items, levels_dict):
                 "Aluno 3 - Nível Snow": nivel_snow_cols[2],
             })
 
-    rows.sort(key=lambda r: (r["Data"], r.get("Horario") or "", r["Atividade"]))
-    alt_idx_by_date = {}
-    for r in rows:
-        if r.get("Pista") in (None, "", "(Sem pista)"):
-            d = r["Data"]
-            i = alt_idx_by_date.get(d, 0)
-            r["Pista"] = "A" if (i % 2 == 0) else "B"
-            alt_idx_by_date[d] = i + 1
+    if not rows:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(rows)
+    df = df.sort_values(["Data", "Horario", "Atividade"], kind="mergesort", na_position="first", ignore_index=True)
+
+    # pista alternada A/B por dia para slots sem pista
+    sem_pista = df["Pista"].isna() | df["Pista"].isin(["", "(Sem pista)"])
+    if sem_pista.any():
+        alt_idx = df.loc[sem_pista].groupby("Data").cumcount().to_numpy()
+        df.loc[sem_pista, "Pista"] = np.where(alt_idx % 2 == 0, "A", "B")
 
-    return rows
+    return df
 
 def _collect_member_ids_from_agenda(agenda_items) -> set[int]:
     """
@@ -1196,29 +1285,36 @@ def gerar_csv(date_from: str | date | None = None, date_to: str | date | None =
     _debug_set("level_errors", level_errors)
     _debug_set("levels_sample", {mid: levels_dict.get(mid) for mid in list(member_ids_t)[:10]})
     
-    rows = _materialize_rows(atividades, agenda_all, levels_dict)
-    if not rows:
+    df = _materialize_rows(atividades, agenda_all, levels_dict)
+    if df.empty:
         raise RuntimeError("Nenhum slot retornado pela API no período solicitado.")
 
-    df = pd.DataFrame(rows)
     if "Bookados" not in df.columns or df["Bookados"].isna().all():
         df["Bookados"] = (df["Capacidade"].fillna(0) - df["Disponíveis"].fillna(0)).clip(lower=0).astype(int)
 
     fname = f"slots_{df_iso_from}_a_{df_iso_to}.csv"
     fpath = os.path.join(DATA_DIR, fname)
     df.to_csv(fpath, index=False, encoding="utf-8-sig")
+    # o shard .parquet é gerado pelo _load_data a partir do CSV relido,
+    # para o dashboard ver exatamente o que o bts_grade_core vê
     return fpath
 
 # ──────────────────────────────────────────────────────────────────────────────
 # CALENDÁRIO
 # ──────────────────────────────────────────────────────────────────────────────
-def _daily_agg(df: pd.DataFrame) -> pd.DataFrame:
-    g = df.groupby("Data", as_index=False).agg(
+def _occupancy_agg(df: pd.DataFrame, keys) -> pd.DataFrame:
+    """Slots/Vagas/Bookados + Ocupacao% por `keys` numa única passada de groupby."""
+    g = df.groupby(keys, as_index=False, observed=True).agg(
         Slots=("Horario", "count"),
         Vagas=("Capacidade", "sum"),
         Bookados=("Bookados", "sum"),
     )
     g["Ocupacao%"] = (g["Bookados"] / g["Vagas"] * 100).replace([np.inf, -np.inf], np.nan).fillna(0).round(1)
+    return g
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _daily_agg(df: pd.DataFrame) -> pd.DataFrame:
+    g = _occupancy_agg(df, "Data")
     g["VagasSobrando"] = (g["Vagas"] - g["Bookados"]).astype(int)
     g["Data"] = pd.to_datetime(g["Data"]).dt.date
     return g
@@ -1226,27 +1322,21 @@ def _daily_agg(df: pd.DataFrame) -> pd.DataFrame:
 def _month_calendar_frame(daily: pd.DataFrame, year: int, month: int) -> pd.DataFrame:
     n_days = pycal.monthrange(year, month)[1]
     first_wd = date(year, month, 1).weekday()
-    rows = []
-    daily_map = daily.set_index("Data").to_dict(orient="index")
-    for d in range(1, n_days + 1):
-        dt_i = date(year, month, d)
-        offset = first_wd + (d - 1)
-        week_idx = offset // 7
-        wd = offset % 7
-        rec = daily_map.get(dt_i, {})
-        rows.append({
-            "Data": dt_i,
-            "day_num": d,
-            "weekday": wd,
-            "week_index": week_idx,
-            "Slots": int(rec.get("Slots", 0) or 0),
-            "Vagas": int(rec.get("Vagas", 0) or 0),
-            "Bookados": int(rec.get("Bookados", 0) or 0),
-            "Ocupacao%": float(rec.get("Ocupacao%", 0.0) or 0.0),
-            "VagasSobrando": int(rec.get("VagasSobrando", 0) or 0),
-        })
-    return pd.DataFrame(rows)
-
+    days = np.arange(1, n_days + 1)
+    offset = first_wd + days - 1
+
+    int_cols = ["Slots", "Vagas", "Bookados", "VagasSobrando"]
+    idx = pd.Index(pd.date_range(date(year, month, 1), periods=n_days).date, name="Data")
+    cal = daily.set_index("Data")[int_cols + ["Ocupacao%"]].reindex(idx)
+    cal[int_cols] = cal[int_cols].fillna(0).astype(int)
+    cal["Ocupacao%"] = cal["Ocupacao%"].fillna(0.0).astype(float)
+    cal = cal.reset_index()
+    cal["day_num"] = days
+    cal["weekday"] = offset % 7
+    cal["week_index"] = offset // 7
+    return cal
+
+@st.cache_data(show_spinner=False, max_entries=32)
 def make_calendar_figure(
     daily_df: pd.DataFrame,
     year: int,
@@ -1259,36 +1349,31 @@ def make_calendar_figure(
     max_week = cal["week_index"].max() if not cal.empty else 5
     n_weeks = int(max_week) + 1
 
-    z = [[None for _ in range(7)] for __ in range(n_weeks)]
-    custom = [[None for _ in range(7)] for __ in range(n_weeks)]
-
-    for _, r in cal.iterrows():
-        wi = int(r["week_index"])
-        wd = int(r["weekday"])
-        slots = int(r["Slots"])
-        vagas = int(r["Vagas"])
-        book = int(r["Bookados"])
-        occ = float(r["Ocupacao%"])
-        sobr = int(r["VagasSobrando"])
-
-        if color_metric == "VagasSobrando":
-            z_val = min(sobr, 10)
-        elif color_metric == "Vagas":
-            z_val = vagas
-        elif color_metric == "Ocupacao%":
-            z_val = occ
-        else:
-            z_val = slots
-
-        z[wi][wd] = float(z_val)
-        custom[wi][wd] = {
-            "data": r["Data"],
-            "slots": slots,
-            "vagas": vagas,
-            "book": book,
-            "occ": occ,
-            "sobr": sobr,
-        }
+    wi_arr = cal["week_index"].to_numpy()
+    wd_arr = cal["weekday"].to_numpy()
+
+    if color_metric == "VagasSobrando":
+        z_vals = np.minimum(cal["VagasSobrando"].to_numpy(), 10)
+    elif color_metric == "Vagas":
+        z_vals = cal["Vagas"].to_numpy()
+    elif color_metric == "Ocupacao%":
+        z_vals = cal["Ocupacao%"].to_numpy()
+    else:
+        z_vals = cal["Slots"].to_numpy()
+
+    z = np.full((n_weeks, 7), np.nan, dtype=np.float32)
+    z[wi_arr, wd_arr] = z_vals
+
+    # customdata[..., k]: 0=data, 1=slots, 2=vagas, 3=bookados, 4=ocupação, 5=sobrando
+    custom = np.full((n_weeks, 7, 6), "", dtype=object)
+    custom[wi_arr, wd_arr] = np.column_stack([
+        pd.to_datetime(cal["Data"]).dt.strftime("%d/%m/%Y").to_numpy(dtype=object),
+        cal["Slots"].to_numpy(),
+        cal["Vagas"].to_numpy(),
+        cal["Bookados"].to_numpy(),
+        cal["Ocupacao%"].to_numpy(),
+        cal["VagasSobrando"].to_numpy(),
+    ])
 
     if color_metric == "Ocupacao%":
         colorscale = "RdYlGn"; zmin, zmax = 0, 100; ctitle = "Ocupação %"
@@ -1309,8 +1394,8 @@ def make_calendar_figure(
     fig = go.Figure(
         data=go.Heatmap(
             z=z,
-            x=list(range(7)),
-            y=list(range(n_weeks)),
+            x=np.arange(7),
+            y=np.arange(n_weeks),
             colorscale=colorscale,
             zmin=zmin,
             zmax=zmax,
@@ -1318,47 +1403,35 @@ def make_calendar_figure(
             colorbar=dict(title=ctitle),
             customdata=custom,
             hovertemplate=(
-                "<b>%{customdata.data|%d/%m/%Y}</b><br>"
-                "Bookados: %{customdata.book}<br>"
-                "Vagas totais: %{customdata.vagas}<br>"
-                "Ocupação: %{customdata.occ:.1f}%<br>"
-                "Vagas sobrando: %{customdata.sobr}<extra></extra>"
+                "<b>%{customdata[0]}</b><br>"
+                "Bookados: %{customdata[3]}<br>"
+                "Vagas totais: %{customdata[2]}<br>"
+                "Ocupação: %{customdata[4]:.1f}%<br>"
+                "Vagas sobrando: %{customdata[5]}<extra></extra>"
             ),
         )
     )
 
     if show_values_in_cell:
-        for _, r in cal.iterrows():
-            wi = int(r["week_index"])
-            wd = int(r["weekday"])
-            sobr = int(r["VagasSobrando"])
-            data_val = r["Data"]
-
-            sobr_display = "+10" if sobr > 10 else str(sobr)
-
-            if isinstance(data_val, (date, datetime)):
-                date_str = data_val.strftime("%d/%m")
-            else:
-                date_str = str(data_val)
-
-            is_dark = False
-            if zmax > 0:
-                is_dark = sobr > zmax * 0.6
-            font_color = "white" if is_dark else "black"
-
-            fig.add_annotation(
-                x=wd,
-                y=wi,
+        sobr_arr = cal["VagasSobrando"].to_numpy()
+        sobr_display = np.where(sobr_arr > 10, "+10", sobr_arr.astype(str))
+        dates_str = pd.to_datetime(cal["Data"]).dt.strftime("%d/%m").to_numpy()
+        is_dark = (sobr_arr > zmax * 0.6) if zmax > 0 else np.zeros(len(cal), dtype=bool)
+        font_colors = np.where(is_dark, "white", "black")
+
+        fig.update_layout(annotations=[
+            dict(
+                x=int(wd),
+                y=int(wi),
                 showarrow=False,
                 xanchor="center",
                 yanchor="middle",
                 align="center",
-                font=dict(size=18, color=font_color),
-                text=(
-                    f"{sobr_display}"
-                    f"<br><span style='font-size:12px'>{date_str}</span>"
-                ),
+                font=dict(size=18, color=fc),
+                text=f"{sd}<br><span style='font-size:12px'>{ds}</span>",
             )
+            for wd, wi, sd, ds, fc in zip(wd_arr, wi_arr, sobr_display, dates_str, font_colors)
+        ])
 
     fig.update_xaxes(
         tickmode="array",
@@ -1385,6 +1458,137 @@ def make_calendar_figure(
     )
     return fig
 
+@st.fragment
+def _render_calendar(daily: pd.DataFrame) -> None:
+    """Calendário mensal; trocar o mês só reexecuta este fragmento."""
+    st.subheader("Calendário (mensal)")
+    if daily.empty:
+        st.info("Sem dados para montar o calendário no período selecionado.")
+    else:
+        hoje = date.today()
+        limite = hoje + timedelta(days=30)
+
+        daily_fut = daily[(daily["Data"] >= hoje) & (daily["Data"] <= limite)].copy()
+        if daily_fut.empty:
+            daily_fut = daily.copy()
+
+        min_m = daily_fut["Data"].min().replace(day=1)
+        max_m = daily_fut["Data"].max().replace(day=1)
+        months_list = []
+        cur = min_m
+        while cur <= max_m:
+            months_list.append(cur)
+            y, m = cur.year, cur.month
+            cur = date(y + 1, 1, 1) if m == 12 else date(y, m + 1, 1)
+
+        month_labels = [f"{pycal.month_name[m.month]} {m.year}" for m in months_list]
+        idx_default = 0
+        sel = st.selectbox(
+            "Selecione o mês",
+            options=list(range(len(months_list))),
+            format_func=lambda i: month_labels[i],
+            index=idx_default,
+        )
+
+        st.caption("Cada quadradinho mostra o número de vagas sobrando em cada dia (próximos 30 dias).")
+
+        sel_month = months_list[sel]
+        dmin = sel_month
+        dmax = sel_month.replace(day=pycal.monthrange(sel_month.year, sel_month.month)[1])
+        daily_month = daily_fut[(daily_fut["Data"] >= dmin) & (daily_fut["Data"] <= dmax)].copy()
+
+        fig_cal = make_calendar_figure(
+            daily_month,
+            sel_month.year,
+            sel_month.month,
+            color_metric="VagasSobrando",
+            show_values_in_cell=True,
+        )
+        st.plotly_chart(fig_cal, width="stretch")
+
+_DAY_CSV_COLS = ["Data", "Vagas", "Bookados", "Ocupacao%", "DiaSemana", "VagasSobrando"]
+
+@st.fragment
+def _render_downloads(
+    df: pd.DataFrame,
+    df_detalhe: pd.DataFrame,
+    grp_day: pd.DataFrame,
+    grp_break: pd.DataFrame,
+) -> None:
+    """Botões de download; cliques reexecutam só este fragmento."""
+    col_a, col_b, col_c, col_d = st.columns(4)
+
+    with col_a:
+        _download_button_csv(
+            df_detalhe,
+            "⬇️ Baixar dados filtrados (CSV)",
+            "dados_filtrados.csv",
+        )
+
+    with col_b:
+        # mesmas colunas/ordem de sempre no export (Slots fica só nos gráficos)
+        _download_button_csv(
+            grp_day.sort_values("Data")[_DAY_CSV_COLS],
+            "⬇️ Baixar ocupação por dia (CSV)",
+            "ocupacao_por_dia.csv",
+        )
+
+    with col_c:
+        selected_cols = [
+            "Pista", "Data", "Início", "Fim", "Atividade",
+            "Capacidade", "Bookados", "Disponíveis",
+            "Professor",
+            "Aluno 1", "Aluno 1 - Nível Ski", "Aluno 1 - Nível Snow",
+            "Aluno 2", "Aluno 2 - Nível Ski", "Aluno 2 - Nível Snow",
+            "Aluno 3", "Aluno 3 - Nível Ski", "Aluno 3 - Nível Snow",
+        ]
+
+        sort_keys = [c for c in ["Data", "Horario", "Atividade"] if c in df.columns]
+        df_sorted = df.sort_values(sort_keys) if sort_keys else df.copy()
+        cols_existentes = [c for c in selected_cols if c in df_sorted.columns]
+        df_excel = df_sorted[cols_existentes]
+
+        st.download_button(
+            label="⬇️ Baixar Grade (XLSX)",
+            data=_xlsx_bytes({"Aulas": df_excel}),
+            file_name="Grade.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+    with col_d:
+        sheets_break = {}
+
+        df_semana = grp_break[grp_break["TipoDia"] == "Semana"]
+        if not df_semana.empty:
+            sheets_break["Semana"] = (
+                df_semana[["Atividade", "Slots", "TotalSlotsTipoDia", "PctSlots"]]
+                .sort_values("PctSlots", ascending=False)
+                .rename(columns={
+                    "Slots": "Slots (aulas)",
+                    "TotalSlotsTipoDia": "Total slots (dias de semana)",
+                    "PctSlots": "% dos slots (semana)",
+                })
+            )
+
+        df_fim = grp_break[grp_break["TipoDia"] == "Fim de semana"]
+        if not df_fim.empty:
+            sheets_break["FimSemana"] = (
+                df_fim[["Atividade", "Slots", "TotalSlotsTipoDia", "PctSlots"]]
+                .sort_values("PctSlots", ascending=False)
+                .rename(columns={
+                    "Slots": "Slots (aulas)",
+                    "TotalSlotsTipoDia": "Total slots (finais de semana)",
+                    "PctSlots": "% dos slots (fim de semana)",
+                })
+            )
+
+        st.download_button(
+            label="⬇️ Breakdown modalidades (XLSX)",
+            data=_xlsx_bytes(sheets_break),
+            file_name="breakdown_modalidades_semana_fimsemana.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
 # ──────────────────────────────────────────────────────────────────────────────
 # APP
 # ──────────────────────────────────────────────────────────────────────────────
@@ -1394,7 +1598,7 @@ st.title(APP_TITLE)
 with st.sidebar:
     st.header("Fonte de dados")
     st.write(f"Lendo CSVs de: `{DATA_DIR}/`")
-    df_slots = _load_data()
+    df_slots = _load_data(_scan_sources())
     if df_slots.empty:
         st.warning("Nenhum arquivo `slots_*.csv` encontrado. Faça upload de um CSV de slots para testar.")
         uploaded = st.file_uploader("Envie um CSV (slots)", type=["csv"])
@@ -1528,15 +1732,17 @@ with col_up_b:
 if df_slots.empty:
     st.stop()
 
-df = df_slots.copy()
-mask = (df["Data"] >= pd.to_datetime(f_date_from).date()) & (df["Data"] <= pd.to_datetime(f_date_to).date())
+# df_slots vem ordenado por Data (datas inválidas no fim): o período vira um fatiamento por busca binária
+_datas_validas = df_slots["Data"].iloc[: int(df_slots["Data"].notna().sum())]
+_lo = int(_datas_validas.searchsorted(pd.to_datetime(f_date_from).date(), side="left"))
+_hi = int(_datas_validas.searchsorted(pd.to_datetime(f_date_to).date(), side="right"))
+df = df_slots.iloc[_lo:_hi]
 if sel_modalidades:
-    mask &= df["Atividade"].isin(sel_modalidades)
+    df = df[df["Atividade"].isin(sel_modalidades)]
 if sel_periodos:
-    mask &= df["Periodo"].isin(sel_periodos)
+    df = df[df["Periodo"].isin(sel_periodos)]
 if sel_horas:
-    mask &= df["Horario"].isin(sel_horas)
-df = df[mask].copy()
+    df = df[df["Horario"].isin(sel_horas)]
 
 if df.empty:
     st.warning("Nenhum dado com os filtros atuais.")
@@ -1556,89 +1762,57 @@ with kpi2: _kpi_block("Vagas (capacidade)", f"{total_capacity}")
 with kpi3: _kpi_block("Bookados", f"{total_booked}")
 with kpi4: _kpi_block("Vagas livres", f"{total_free}")
 
-grp_day = df.groupby("Data", as_index=False).agg(
-    Vagas=("Capacidade", "sum"),
-    Bookados=("Bookados", "sum"),
-)
-grp_day["Ocupacao%"] = (grp_day["Bookados"] / grp_day["Vagas"] * 100).replace([np.inf, -np.inf], np.nan).fillna(0).round(1)
+# um único groupby por Data alimenta os gráficos diários e o calendário
+daily = _daily_agg(df)
+grp_day = daily.sort_values("Data")
 
 _weekdays_pt = ["Seg", "Ter", "Qua", "Qui", "Sex", "Sáb", "Dom"]
-grp_day["DiaSemana"] = pd.to_datetime(grp_day["Data"]).dt.dayofweek.map(lambda i: _weekdays_pt[int(i)] if pd.notna(i) else "")
-
-fig1 = px.bar(
-    grp_day.sort_values("Data"),
-    x="Data",
-    y="Ocupacao%",
-    title="Ocupação por Dia",
-    labels={"Ocupacao%": "Ocupação (%)", "Data": "Data"},
-    text="Ocupacao%",
+# Data vem do groupby, nunca é nula: o dia da semana já é o código da categoria
+grp_day["DiaSemana"] = pd.Categorical.from_codes(
+    pd.to_datetime(grp_day["Data"]).dt.dayofweek.to_numpy(), categories=_weekdays_pt, ordered=True
 )
-fig1.update_traces(
-    texttemplate="%{text:.1f}%",
-    textposition="outside",
-    hovertemplate="<b>%{x|%d/%m/%Y}</b><br>Dia: %{customdata[0]}<br>Ocupação: %{y:.1f}%<extra></extra>",
-    customdata=np.stack([grp_day["DiaSemana"]], axis=-1),
+grp_day["VagasSobrando"] = grp_day["VagasSobrando"].clip(lower=0)
+
+# os três gráficos diários compartilham o eixo X numa única figura
+dow_arr = grp_day["DiaSemana"].to_numpy()[:, None]
+day_series = [
+    ("Ocupacao%", "Ocupação (%)", "%{text:.1f}%", "Ocupação: %{y:.1f}%"),
+    ("Bookados", "Clientes (bookados)", "%{text:d}", "Clientes: %{y:d}"),
+    ("VagasSobrando", "Vagas sobrando", "%{text:d}", "Vagas sobrando: %{y:d}"),
+]
+fig1 = make_subplots(
+    rows=3,
+    cols=1,
+    shared_xaxes=True,
+    vertical_spacing=0.08,
+    subplot_titles=("Ocupação por Dia", "Clientes bookados por dia", "Vagas sobrando por dia"),
 )
+for row, (col, y_title, text_tpl, hover_line) in enumerate(day_series, start=1):
+    fig1.add_trace(
+        go.Bar(
+            x=grp_day["Data"],
+            y=grp_day[col],
+            text=grp_day[col],
+            texttemplate=text_tpl,
+            textposition="outside",
+            customdata=dow_arr,
+            hovertemplate="<b>%{x|%d/%m/%Y}</b><br>Dia: %{customdata[0]}<br>" + hover_line + "<extra></extra>",
+            showlegend=False,
+        ),
+        row=row,
+        col=1,
+    )
+    fig1.update_yaxes(title_text=y_title, row=row, col=1)
+fig1.update_xaxes(title_text="Data", row=3, col=1)
 fig1.update_layout(
-    yaxis_title="Ocupação (%)",
+    height=1100,
     margin=dict(t=60, b=40),
     uniformtext_minsize=8,
     uniformtext_mode="hide",
 )
 st.plotly_chart(fig1, use_container_width=True)
 
-fig1b = px.bar(
-    grp_day.sort_values("Data"),
-    x="Data",
-    y="Bookados",
-    title="Clientes bookados por dia",
-    labels={"Bookados": "Clientes", "Data": "Data"},
-    text="Bookados",
-)
-fig1b.update_traces(
-    texttemplate="%{text:d}",
-    textposition="outside",
-    hovertemplate="<b>%{x|%d/%m/%Y}</b><br>Dia: %{customdata[0]}<br>Clientes: %{y:d}<extra></extra>",
-    customdata=np.stack([grp_day["DiaSemana"]], axis=-1)
-)
-fig1b.update_layout(
-    uniformtext_minsize=8,
-    uniformtext_mode="hide",
-    yaxis_title="Clientes (bookados)",
-    margin=dict(t=60, b=40),
-)
-st.plotly_chart(fig1b, use_container_width=True)
-
-grp_day["VagasSobrando"] = (grp_day["Vagas"] - grp_day["Bookados"]).clip(lower=0).astype(int)
-
-fig1c = px.bar(
-    grp_day.sort_values("Data"),
-    x="Data",
-    y="VagasSobrando",
-    title="Vagas sobrando por dia",
-    labels={"VagasSobrando": "Vagas sobrando", "Data": "Data"},
-    text="VagasSobrando",
-)
-fig1c.update_traces(
-    texttemplate="%{text:d}",
-    textposition="outside",
-    hovertemplate="<b>%{x|%d/%m/%Y}</b><br>Dia: %{customdata[0]}<br>Vagas sobrando: %{y:d}<extra></extra>",
-    customdata=np.stack([grp_day["DiaSemana"]], axis=-1),
-)
-fig1c.update_layout(
-    uniformtext_minsize=8,
-    uniformtext_mode="hide",
-    yaxis_title="Vagas sobrando",
-    margin=dict(t=60, b=40),
-)
-st.plotly_chart(fig1c, use_container_width=True)
-
-grp_mod = df.groupby("Atividade", as_index=False).agg(
-    Vagas=("Capacidade", "sum"),
-    Bookados=("Bookados", "sum"),
-    Slots=("Horario", "count")
-)
-grp_mod["Ocupacao%"] = (grp_mod["Bookados"] / grp_mod["Vagas"] * 100).replace([np.inf, -np.inf], np.nan).fillna(0).round(1)
+grp_mod = _occupancy_agg(df, "Atividade")
 
 fig2 = px.bar(
     grp_mod.sort_values("Ocupacao%", ascending=False),
@@ -1658,19 +1832,20 @@ fig2.update_layout(
 )
 st.plotly_chart(fig2, width="stretch")
 
-grp_per = df.groupby("Periodo", as_index=False).agg(Vagas=("Capacidade", "sum"), Bookados=("Bookados", "sum"), Slots=("Horario", "count"))
-grp_per["Ocupacao%"] = (grp_per["Bookados"] / grp_per["Vagas"] * 100).replace([np.inf, -np.inf], np.nan).fillna(0).round(1)
+grp_per = _occupancy_agg(df, "Periodo")
 order_map = {"Manhã": 0, "Tarde": 1, "Noite": 2, "Indefinido": 3}
-grp_per = grp_per.sort_values(by="Periodo", key=lambda s: s.map(order_map))
+grp_per = grp_per.sort_values(by="Periodo", key=lambda s: s.astype(object).map(order_map))
 fig3 = px.bar(grp_per, x="Periodo", y="Ocupacao%", title="Ocupação por Período", labels={"Ocupacao%": "Ocupação (%)", "Periodo": "Período"})
 st.plotly_chart(fig3, width="stretch")
 
-df_prof = df.copy()
-if "Professor" not in df_prof.columns or df_prof["Professor"].isna().all():
+if "Professor" not in df.columns or df["Professor"].isna().all():
     st.info("Ainda não há dados de professor neste arquivo/período. Gere um CSV novo em “🔄 Atualizar agora”.")
 else:
-    df_prof["Professor"] = df_prof["Professor"].fillna("(Sem professor)")
-    grp_prof = df_prof.groupby("Professor", as_index=False).agg(
+    prof = df["Professor"].astype("category")
+    if "(Sem professor)" not in prof.cat.categories:
+        prof = prof.cat.add_categories(["(Sem professor)"])
+    df_prof = df.assign(Professor=prof.fillna("(Sem professor)"))
+    grp_prof = df_prof.groupby("Professor", as_index=False, observed=True).agg(
         Aulas=("Horario", "count"),
         Bookados=("Bookados", "sum"),
     ).sort_values("Aulas", ascending=False)
@@ -1690,170 +1865,31 @@ else:
     fig_prof.update_layout(xaxis_tickangle=-25, margin=dict(t=60, b=80))
     st.plotly_chart(fig_prof, use_container_width=True)
 
-grp_hh = df.groupby(["Data", "Horario"], as_index=False).agg(Vagas=("Capacidade", "sum"), Bookados=("Bookados", "sum"))
-grp_hh["Ocupacao%"] = (grp_hh["Bookados"] / grp_hh["Vagas"] * 100).replace([np.inf, -np.inf], np.nan).fillna(0).round(1)
-grp_hh = grp_hh.sort_values(by="Horario", key=lambda s: s.map(_hhmm_to_minutes))
+grp_hh = _occupancy_agg(df, ["Data", "Horario", "HorarioMin"])
+grp_hh = grp_hh.sort_values("HorarioMin", kind="stable").drop(columns=["HorarioMin"])
 fig4 = px.density_heatmap(grp_hh, x="Data", y="Horario", z="Ocupacao%", color_continuous_scale="RdYlGn", title="Heatmap — Ocupação por Data × Horário", nbinsx=len(grp_hh["Data"].unique()))
 fig4.update_coloraxes(colorbar_title="Ocupação %", cmin=0, cmax=100)
 st.plotly_chart(fig4, width="stretch")
 
 st.divider()
 
-st.subheader("Calendário (mensal)")
-daily = _daily_agg(df)
-if daily.empty:
-    st.info("Sem dados para montar o calendário no período selecionado.")
-else:
-    hoje = date.today()
-    limite = hoje + timedelta(days=30)
-
-    daily_fut = daily[(daily["Data"] >= hoje) & (daily["Data"] <= limite)].copy()
-    if daily_fut.empty:
-        daily_fut = daily.copy()
-
-    min_m = daily_fut["Data"].min().replace(day=1)
-    max_m = daily_fut["Data"].max().replace(day=1)
-    months_list = []
-    cur = min_m
-    while cur <= max_m:
-        months_list.append(cur)
-        y, m = cur.year, cur.month
-        cur = date(y + 1, 1, 1) if m == 12 else date(y, m + 1, 1)
-
-    month_labels = [f"{pycal.month_name[m.month]} {m.year}" for m in months_list]
-    idx_default = 0
-    sel = st.selectbox(
-        "Selecione o mês",
-        options=list(range(len(months_list))),
-        format_func=lambda i: month_labels[i],
-        index=idx_default,
-    )
-
-    st.caption("Cada quadradinho mostra o número de vagas sobrando em cada dia (próximos 30 dias).")
-
-    sel_month = months_list[sel]
-    dmin = sel_month
-    dmax = sel_month.replace(day=pycal.monthrange(sel_month.year, sel_month.month)[1])
-    daily_month = daily_fut[(daily_fut["Data"] >= dmin) & (daily_fut["Data"] <= dmax)].copy()
-
-    fig_cal = make_calendar_figure(
-        daily_month,
-        sel_month.year,
-        sel_month.month,
-        color_metric="VagasSobrando",
-        show_values_in_cell=True,
-    )
-    st.plotly_chart(fig_cal, width="stretch")
+_render_calendar(daily)
 
 st.divider()
 
-df_break = df.copy()
-df_break["DataDT"] = pd.to_datetime(df_break["Data"])
-df_break["TipoDia"] = df_break["DataDT"].dt.dayofweek.apply(lambda x: "Semana" if x < 5 else "Fim de semana")
+dow = pd.to_datetime(df["Data"]).dt.dayofweek.to_numpy()
+tipo_dia = np.where(dow < 5, "Semana", "Fim de semana")
+df_break = df.assign(TipoDia=pd.Categorical(tipo_dia, categories=["Semana", "Fim de semana"]))
 
-grp_break = df_break.groupby(["TipoDia", "Atividade"], as_index=False).agg(Slots=("Horario", "count"))
-grp_break["TotalSlotsTipoDia"] = grp_break.groupby("TipoDia")["Slots"].transform("sum")
+grp_break = df_break.groupby(["TipoDia", "Atividade"], as_index=False, observed=True).agg(Slots=("Horario", "count"))
+grp_break["TotalSlotsTipoDia"] = grp_break.groupby("TipoDia", observed=True)["Slots"].transform("sum")
 grp_break["PctSlots"] = (grp_break["Slots"] / grp_break["TotalSlotsTipoDia"] * 100).round(1)
 
 st.subheader("Dados filtrados (detalhado)")
-st.dataframe(df.sort_values(["Data", "Horario", "Atividade"]).reset_index(drop=True), use_container_width=True, height=420)
-
-col_a, col_b, col_c, col_d = st.columns(4)
-
-with col_a:
-    _download_button_csv(
-        df.sort_values(["Data", "Horario", "Atividade"]),
-        "⬇️ Baixar dados filtrados (CSV)",
-        "dados_filtrados.csv",
-    )
-
-with col_b:
-    _download_button_csv(
-        grp_day.sort_values("Data"),
-        "⬇️ Baixar ocupação por dia (CSV)",
-        "ocupacao_por_dia.csv",
-    )
+df_detalhe = df.drop(columns=["HorarioMin"]).sort_values(["Data", "Horario", "Atividade"])
+st.dataframe(df_detalhe.reset_index(drop=True), use_container_width=True, height=420)
 
-with col_c:
-    selected_cols = [
-        "Pista", "Data", "Início", "Fim", "Atividade",
-        "Capacidade", "Bookados", "Disponíveis",
-        "Professor",
-        "Aluno 1", "Aluno 1 - Nível Ski", "Aluno 1 - Nível Snow",
-        "Aluno 2", "Aluno 2 - Nível Ski", "Aluno 2 - Nível Snow",
-        "Aluno 3", "Aluno 3 - Nível Ski", "Aluno 3 - Nível Snow",
-    ]
-
-    sort_keys = [c for c in ["Data", "Horario", "Atividade"] if c in df.columns]
-    df_sorted = df.sort_values(sort_keys) if sort_keys else df.copy()
-    cols_existentes = [c for c in selected_cols if c in df_sorted.columns]
-    df_excel = df_sorted[cols_existentes]
-
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        df_excel.to_excel(writer, index=False, sheet_name="Aulas")
-        worksheet = writer.sheets["Aulas"]
-        for i, col in enumerate(df_excel.columns):
-            col_max = df_excel[col].astype(str).str.len().max()
-            max_len = max(col_max if pd.notna(col_max) else 0, len(col)) + 2
-            worksheet.set_column(i, i, min(max_len, 40))
-
-    st.download_button(
-        label="⬇️ Baixar Grade (XLSX)",
-        data=buffer.getvalue(),
-        file_name="Grade.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
-
-with col_d:
-    buffer_break = io.BytesIO()
-    with pd.ExcelWriter(buffer_break, engine="xlsxwriter") as writer:
-        df_semana = grp_break[grp_break["TipoDia"] == "Semana"].copy()
-        if not df_semana.empty:
-            df_semana = df_semana[["Atividade", "Slots", "TotalSlotsTipoDia", "PctSlots"]]
-            df_semana = df_semana.sort_values("PctSlots", ascending=False)
-            df_semana.rename(
-                columns={
-                    "Slots": "Slots (aulas)",
-                    "TotalSlotsTipoDia": "Total slots (dias de semana)",
-                    "PctSlots": "% dos slots (semana)",
-                },
-                inplace=True,
-            )
-            df_semana.to_excel(writer, index=False, sheet_name="Semana")
-            ws = writer.sheets["Semana"]
-            for i, col in enumerate(df_semana.columns):
-                col_max = df_semana[col].astype(str).str.len().max()
-                max_len = max(col_max if pd.notna(col_max) else 0, len(col)) + 2
-                ws.set_column(i, i, min(max_len, 40))
-
-        df_fim = grp_break[grp_break["TipoDia"] == "Fim de semana"].copy()
-        if not df_fim.empty:
-            df_fim = df_fim[["Atividade", "Slots", "TotalSlotsTipoDia", "PctSlots"]]
-            df_fim = df_fim.sort_values("PctSlots", ascending=False)
-            df_fim.rename(
-                columns={
-                    "Slots": "Slots (aulas)",
-                    "TotalSlotsTipoDia": "Total slots (finais de semana)",
-                    "PctSlots": "% dos slots (fim de semana)",
-                },
-                inplace=True,
-            )
-            df_fim.to_excel(writer, index=False, sheet_name="FimSemana")
-            ws = writer.sheets["FimSemana"]
-            for i, col in enumerate(df_fim.columns):
-                col_max = df_fim[col].astype(str).str.len().max()
-                max_len = max(col_max if pd.notna(col_max) else 0, len(col)) + 2
-                ws.set_column(i, i, min(max_len, 40))
-
-    buffer_break.seek(0)
-
-    st.download_button(
-        label="⬇️ Breakdown modalidades (XLSX)",
-        data=buffer_break.getvalue(),
-        file_name="breakdown_modalidades_semana_fimsemana.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+_render_downloads(df, df_detalhe, grp_day, grp_break)
 
 st.divider()
 st.subheader("📋 Escala de Professores")
@@ -1862,19 +1898,9 @@ cols_prof = ["Data", "Início", "Fim", "Pista", "Atividade", "Professor"]
 cols_existentes = [c for c in cols_prof if c in df.columns]
 df_prof_escala = df[cols_existentes].sort_values(["Data", "Início", "Atividade"])
 
-buffer_prof = io.BytesIO()
-with pd.ExcelWriter(buffer_prof, engine="xlsxwriter") as writer:
-    df_prof_escala.to_excel(writer, index=False, sheet_name="Escala")
-    worksheet = writer.sheets["Escala"]
-    for i, col in enumerate(df_prof_escala.columns):
-        col_max = df_prof_escala[col].astype(str).str.len().max()
-        max_len = max(col_max if pd.notna(col_max) else 0, len(col)) + 2
-        worksheet.set_column(i, i, min(max_len, 40))
-buffer_prof.seek(0)
-
 st.download_button(
     label="⬇️ Baixar Escala de Professores",
-    data=buffer_prof.getvalue(),
+    data=_xlsx_bytes({"Escala": df_prof_escala}),
     file_name="escala_professores.xlsx",
     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
 )
@@ -1,15 +1,23 @@
 # db.py
 # Banco interno de clientes + histórico de nível Born to Ski
 
+import atexit
+import csv
+import hashlib
 import os
+import re
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from datetime import date
 
 import pandas as pd
 import base64
 import io
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Caminho do banco
 DATA_DIR = Path("data")
@@ -19,7 +27,25 @@ GITHUB_OWNER = os.environ.get("GITHUB_OWNER", "")
 GITHUB_REPO = os.environ.get("GITHUB_REPO", "")
 GITHUB_BRANCH = os.environ.get("GITHUB_BRANCH", "main")
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN", "")
-ACCIDENTS_CSV_PATH = os.path.join(DATA_DIR, "acidentes.csv")
+ACCIDENTS_CSV_PATH = DATA_DIR / "acidentes.csv"
+# Sessão única para a API/raw do GitHub: reaproveita a conexão TLS entre
+# chamadas. Só GETs são repetidos em erro 5xx; um PUT repetido poderia
+# gerar commit duplicado ou 409 por sha desatualizado
+_GH_SESSION = requests.Session()
+_GH_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset({"GET"}),
+        ),
+    ),
+)
+
+
 def _github_headers():
     if not GITHUB_TOKEN:
         return None
@@ -39,17 +65,109 @@ def _github_file_url(path_in_repo: str) -> str:
 # Conexão / inicialização
 # ---------------------------------------------------------------------------
 
+# DDL do schema roda uma vez por processo (e de novo se o arquivo for recriado)
+_DB_INITIALIZED = False
+_INIT_LOCK = threading.Lock()
+
+# journal_mode=WAL fica gravado no próprio arquivo: basta aplicar uma vez por
+# processo (e de novo se o arquivo for apagado/recriado)
+_WAL_READY = False
+
+
 def get_connection() -> sqlite3.Connection:
-    """Abre conexão com o SQLite garantindo PRAGMAs básicos."""
-    conn = sqlite3.connect(DB_PATH)
+    """Abre conexão com o SQLite garantindo PRAGMAs básicos e de desempenho."""
+    global _WAL_READY
+    conn = sqlite3.connect(DB_PATH, timeout=5.0, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
+    if not _WAL_READY:
+        conn.execute("PRAGMA journal_mode = WAL;")
+        _WAL_READY = True
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA busy_timeout = 5000;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -20000;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
     return conn
 
 
+# Conexões do processo usadas pelas funções deste módulo: uma de escrita e uma
+# só de leitura, abertas sob demanda e compartilhadas entre as threads (o
+# Streamlit roda cada rerun numa thread nova, então conexão por thread vaza).
+# O sqlite3 não serializa o uso concorrente de uma mesma conexão: cada uma só
+# é usada com o seu lock na mão. Locks separados porque, em WAL, a leitura não
+# precisa esperar uma transação de escrita em andamento
+_CONNS: dict[str, sqlite3.Connection] = {}
+_CONN_LOCKS = {"rw": threading.RLock(), "ro": threading.RLock()}
+
+
+@contextmanager
+def _pooled_connection(kind: str):
+    with _CONN_LOCKS[kind]:
+        conn = _CONNS.get(kind)
+        if conn is None:
+            conn = get_connection()
+            if kind == "ro":
+                conn.execute("PRAGMA query_only = ON;")
+            else:
+                # BEGIN IMMEDIATE: pega o lock de escrita já no início da transação,
+                # em vez de falhar com SQLITE_BUSY ao promover um BEGIN deferred
+                conn.isolation_level = "IMMEDIATE"
+            _CONNS[kind] = conn
+        yield conn
+
+
+def _shared_connection():
+    """Conexão de escrita do processo (`with _shared_connection() as conn:`; não feche)."""
+    return _pooled_connection("rw")
+
+
+def _read_connection():
+    """Conexão somente leitura do processo (PRAGMA query_only)."""
+    return _pooled_connection("ro")
+
+
+def _close_shared_connections() -> None:
+    with _CONN_LOCKS["rw"], _CONN_LOCKS["ro"]:
+        for conn in _CONNS.values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _CONNS.clear()
+
+
+atexit.register(_close_shared_connections)
+
+
+def _unlink_db_files() -> None:
+    """Remove o .db e os arquivos -wal/-shm do modo WAL."""
+    global _WAL_READY, _DB_INITIALIZED
+    _close_shared_connections()
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{DB_PATH}{suffix}").unlink(missing_ok=True)
+    _WAL_READY = False
+    _DB_INITIALIZED = False
+
+
 def init_db_if_needed() -> None:
-    """Cria as tabelas se ainda não existirem."""
-    conn = get_connection()
+    """Cria as tabelas se ainda não existirem (só na primeira chamada do processo)."""
+    global _DB_INITIALIZED
+    if _DB_INITIALIZED:
+        return
+    with _INIT_LOCK:
+        if _DB_INITIALIZED:
+            return
+        _create_schema()
+        _DB_INITIALIZED = True
+
+
+def _create_schema() -> None:
+    with _shared_connection() as conn:
+        _create_schema_on(conn)
+
+
+def _create_schema_on(conn: sqlite3.Connection) -> None:
     cur = conn.cursor()
 
     # Tabela principal de clientes
@@ -94,14 +212,68 @@ def init_db_if_needed() -> None:
         """
     )
 
+    # Snapshot diário de quantidade de clientes
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_clients (
+            data TEXT PRIMARY KEY,
+            total_clientes INTEGER NOT NULL,
+            novos_clientes INTEGER NOT NULL
+        );
+        """
+    )
+
+    # Índices das consultas quentes:
+    # - nível anterior no sync (JOIN do lote com clients) só pelo índice
+    # - histórico por cliente / completo (página 3), já na ordem do ORDER BY
+    # - lista de clientes ordenada por nome (página 3)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_clients_evo_ordem ON clients(evo_id, nivel_ordem);"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_level_history_evo_data ON level_history(evo_id, data, id);"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_clients_nome_nocase ON clients(nome_limpo COLLATE NOCASE);"
+    )
+
     conn.commit()
-    conn.close()
 
-def _upload_bytes_to_github(path_in_repo: str, content: bytes, message: str) -> dict:
+    # estatísticas para o planner escolher os índices acima (só analisa o que precisa)
+    conn.execute("PRAGMA optimize;")
+
+def _git_blob_sha(content: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def _github_get_file(path_in_repo: str) -> dict | None:
+    """Metadados do arquivo na branch configurada (inclui o sha), ou None se não existir."""
+    headers = _github_headers()
+    if not headers:
+        raise RuntimeError("GITHUB_TOKEN não configurado (sem backup possível).")
+
+    resp = _GH_SESSION.get(
+        _github_file_url(path_in_repo), headers=headers, params={"ref": GITHUB_BRANCH}, timeout=30
+    )
+    if resp.status_code == 200:
+        return resp.json()
+    if resp.status_code == 404:
+        return None
+    raise RuntimeError(f"[GitHub GET] {resp.status_code} - {resp.text}")
+
+
+_NOT_FETCHED = object()
+
+
+def _upload_bytes_to_github(
+    path_in_repo: str, content: bytes, message: str, remote=_NOT_FETCHED
+) -> dict:
     """
     Cria/atualiza um arquivo no GitHub usando a API de contents.
     Levanta erro se falhar (pra Streamlit mostrar na tela).
-    Retorna o JSON da resposta do PUT (inclui commit, content, etc.)
+    `remote` aceita o resultado de _github_get_file já buscado antes.
+    Retorna o JSON da resposta do PUT (inclui commit, content, etc.), ou
+    {"content": ..., "unchanged": True} se o arquivo remoto já for idêntico.
     """
     headers = _github_headers()
     if not headers:
@@ -110,14 +282,13 @@ def _upload_bytes_to_github(path_in_repo: str, content: bytes, message: str) ->
     url = _github_file_url(path_in_repo)
 
     # 1) Descobre o SHA do arquivo na branch correta (se existir)
-    resp = requests.get(url, headers=headers, params={"ref": GITHUB_BRANCH}, timeout=30)
+    if remote is _NOT_FETCHED:
+        remote = _github_get_file(path_in_repo)
 
-    if resp.status_code == 200:
-        sha = resp.json().get("sha")
-    elif resp.status_code == 404:
-        sha = None
-    else:
-        raise RuntimeError(f"[GitHub GET] {resp.status_code} - {resp.text}")
+    sha = remote.get("sha") if remote else None
+    # o sha da API de contents é o blob sha do git: conteúdo igual, nada a enviar
+    if sha and sha == _git_blob_sha(content):
+        return {"content": remote, "unchanged": True}
 
     data = {
         "message": message,
@@ -127,7 +298,7 @@ def _upload_bytes_to_github(path_in_repo: str, content: bytes, message: str) ->
     if sha:
         data["sha"] = sha
 
-    put_resp = requests.put(url, headers=headers, json=data, timeout=30)
+    put_resp = _GH_SESSION.put(url, headers=headers, json=data, timeout=30)
     if put_resp.status_code not in (200, 201):
         raise RuntimeError(f"[GitHub PUT] {put_resp.status_code} - {put_resp.text}")
 
@@ -139,25 +310,38 @@ def backup_db_to_github() -> dict:
     Retorna dict com status por tabela.
     """
     init_db_if_needed()
-    conn = get_connection()
-
-    results = {}
-    for table in ["clients", "level_history", "daily_clients"]:
-        df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
-        csv_bytes = df.to_csv(index=False).encode("utf-8-sig")
-
-        path_repo = f"backups/{table}.csv"
-        msg = f"Snapshot automático da tabela {table}"
-
-        results[table] = _upload_bytes_to_github(path_repo, csv_bytes, msg)
+    tables = ["clients", "level_history", "daily_clients"]
+
+    # os GETs de sha são independentes: saem em paralelo enquanto os CSVs são
+    # gerados. Os PUTs continuam em série, porque cada um vira um commit na
+    # mesma branch e PUTs concorrentes dão conflito (409) na API de contents
+    with ThreadPoolExecutor(max_workers=len(tables)) as ex:
+        remotes = {t: ex.submit(_github_get_file, f"backups/{t}.csv") for t in tables}
+
+        csvs = {}
+        with _read_connection() as conn:
+            for table in tables:
+                # linhas do cursor direto pro csv.writer, sem montar DataFrame
+                buf = io.StringIO()
+                writer = csv.writer(buf, lineterminator="\n")
+                cur = conn.execute(f"SELECT * FROM {table}")
+                writer.writerow([d[0] for d in cur.description])
+                writer.writerows(cur)
+                csvs[table] = buf.getvalue().encode("utf-8-sig")
+
+        results = {}
+        for table in tables:
+            path_repo = f"backups/{table}.csv"
+            msg = f"Snapshot automático da tabela {table}"
+            results[table] = _upload_bytes_to_github(
+                path_repo, csvs[table], msg, remote=remotes[table].result()
+            )
 
-    conn.close()
     return results
 
 def wipe_db() -> None:
     """Apaga completamente o banco (usado só manualmente / debug)."""
-    if DB_PATH.exists():
-        DB_PATH.unlink()
+    _unlink_db_files()
 
 def restore_db_from_github() -> int:
     """
@@ -174,46 +358,41 @@ def restore_db_from_github() -> int:
         raise RuntimeError("GITHUB_OWNER e GITHUB_REPO não configurados.")
 
     # Apaga o DB atual (se existir)
-    if DB_PATH.exists():
-        DB_PATH.unlink()
+    _unlink_db_files()
 
     # Cria o arquivo e as tabelas vazias
     init_db_if_needed()
-    conn = get_connection()
 
     base_raw = f"https://raw.githubusercontent.com/{GITHUB_OWNER}/{GITHUB_REPO}/{GITHUB_BRANCH}/backups"
     total_rows = 0
 
-    for table in ["clients", "level_history", "daily_clients"]:
-        url = f"{base_raw}/{table}.csv"
-        try:
-            resp = requests.get(url, timeout=10)
-            if resp.status_code != 200:
-                print(f"[restore_db_from_github] CSV de {table} não encontrado ({resp.status_code}).")
-                continue
-
-            csv_text = resp.text
-            df = pd.read_csv(io.StringIO(csv_text))
-            if not df.empty:
-                df.to_sql(table, conn, if_exists="append", index=False)
-                total_rows += len(df)
-                print(f"[restore_db_from_github] Importadas {len(df)} linhas em {table}.")
-        except Exception as e:
-            print(f"[restore_db_from_github] Erro ao restaurar {table}: {e}")
-
-    conn.commit()
-    conn.close()
+    with _shared_connection() as conn:
+        for table in ["clients", "level_history", "daily_clients"]:
+            url = f"{base_raw}/{table}.csv"
+            try:
+                resp = _GH_SESSION.get(url, timeout=10)
+                if resp.status_code != 200:
+                    print(f"[restore_db_from_github] CSV de {table} não encontrado ({resp.status_code}).")
+                    continue
+
+                csv_text = resp.text
+                df = pd.read_csv(io.StringIO(csv_text))
+                if not df.empty:
+                    df.to_sql(table, conn, if_exists="append", index=False)
+                    total_rows += len(df)
+                    print(f"[restore_db_from_github] Importadas {len(df)} linhas em {table}.")
+            except Exception as e:
+                print(f"[restore_db_from_github] Erro ao restaurar {table}: {e}")
+
+        conn.commit()
 
     return total_rows
 
 def backup_acidentes_to_github() -> dict:
-    from pathlib import Path
-
-    csv_path = Path(ACCIDENTS_CSV_PATH)
-    if not csv_path.exists():
-        raise FileNotFoundError("Arquivo de acidentes não encontrado.")
-
-    content = csv_path.read_bytes()
+    try:
+        content = ACCIDENTS_CSV_PATH.read_bytes()
+    except FileNotFoundError:
+        raise FileNotFoundError("Arquivo de acidentes não encontrado.") from None
     return _upload_bytes_to_github(
         "backups/acidentes.csv",
         content,
@@ -227,8 +406,6 @@ def restore_acidentes_from_github() -> int:
 
     Retorna o número de linhas restauradas (ou 0 em caso de erro).
     """
-    from pathlib import Path
-
     if not GITHUB_OWNER or not GITHUB_REPO:
         raise RuntimeError("GITHUB_OWNER e GITHUB_REPO não configurados.")
 
@@ -236,7 +413,7 @@ def restore_acidentes_from_github() -> int:
     url = f"{base_raw}/backups/acidentes.csv"
 
     try:
-        resp = requests.get(url, timeout=10)
+        resp = _GH_SESSION.get(url, timeout=10)
         if resp.status_code != 200:
             print(
                 f"[restore_acidentes_from_github] CSV de acidentes não encontrado "
@@ -246,7 +423,7 @@ def restore_acidentes_from_github() -> int:
 
         content = resp.content
 
-        csv_path = Path(ACCIDENTS_CSV_PATH)
+        csv_path = ACCIDENTS_CSV_PATH
         csv_path.parent.mkdir(parents=True, exist_ok=True)
 
         with csv_path.open("wb") as f:
@@ -278,6 +455,11 @@ LEVEL_ORDER = {
 }
 
 
+# aceita "2B", "2 B", "1BSK", "2CSB", "3A.", "4C+"; dígito e letra em grupos
+# separados já dão o nível normalizado ("2 B" -> "2B")
+_LEVEL_RE = re.compile(r"([1-4])\s*([A-D])")
+
+
 def _extract_nome_e_nivel(nome_bruto: str):
     """
     Recebe o nome como vem do EVO, ex:
@@ -299,35 +481,166 @@ def _extract_nome_e_nivel(nome_bruto: str):
     if not texto:
         return "", None
 
-    import re
-
-    # aceita "2B", "2 B", "1BSK", "2CSB", "3A.", "4C+"
-    pattern = r"([1-4]\s*[A-D])"
-    matches = re.findall(pattern, texto.upper())
-
-    if not matches:
+    # sem dígito 1-4 não há nível: nem passa pelo regex
+    if not any(d in texto for d in "1234"):
         return texto, None
 
-    # normaliza "2 B" -> "2B"
-    matches = [m.replace(" ", "") for m in matches]
+    # pega o maior nível: todo match já é válido (1A..4D) e a ordem é
+    # (dígito, letra), então basta comparar os códigos dos dois caracteres
+    best = None
+    best_ord = -1
+    for m in _LEVEL_RE.finditer(texto.upper()):
+        o = (ord(m[1]) - 49) * 4 + (ord(m[2]) - 65)
+        if o > best_ord:
+            best_ord, best = o, m[1] + m[2]
 
-    # mantém só níveis válidos (1A..4D)
-    matches = [m for m in matches if m in LEVEL_ORDER]
-    if not matches:
+    if best is None:
         return texto, None
 
-    # pega o maior nível
-    best = max(matches, key=lambda x: LEVEL_ORDER.get(x, -1))
-
     # por enquanto deixamos o nome inteiro como "limpo"
     nome_limpo = texto.strip()
 
     return nome_limpo, best
 
+
+def _extract_niveis(nomes: pd.Series) -> pd.Series:
+    """
+    Versão vetorizada de _extract_nome_e_nivel para uma coluna inteira:
+    retorna o maior nível (1A..4D) de cada nome, ou None.
+    """
+    # trabalha por posição: o índice do chamador pode ter rótulos repetidos,
+    # e agrupar/reindexar por rótulo misturaria os níveis de clientes diferentes
+    pos = nomes.reset_index(drop=True)
+
+    # extractall (MultiIndex por match) só nos nomes que têm algum dígito 1-4
+    candidatos = pos[pos.str.contains("[1-4]", regex=True)]
+    parts = candidatos.str.upper().str.extractall(_LEVEL_RE)
+    found = parts[0] + parts[1]
+    # "1A" < ... < "4D" em ordem lexicográfica, igual a LEVEL_ORDER
+    best = found.groupby(level=0).max().reindex(pos.index)
+
+    arr = best.to_numpy(dtype=object, copy=True)
+    arr[pd.isna(arr)] = None
+    return pd.Series(arr, index=nomes.index, dtype=object)
+
 # ---------------------------------------------------------------------------
 # Sincronização de clientes + histórico de nível
 # ---------------------------------------------------------------------------
 
+_CLIENT_COLS_SQL = """
+    evo_id, nome_bruto, nome_limpo, sexo, nascimento, idade,
+    rua, numero, complemento, bairro, cidade, uf, cep,
+    email, telefone, criado_em, nivel_atual, nivel_ordem
+"""
+
+# Lote do sync fica numa tabela temporária da conexão; upsert e histórico
+# saem dela em uma instrução cada
+_CREATE_CLIENTS_STAGE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS clients_stage (
+        seq           INTEGER PRIMARY KEY,
+        evo_id        TEXT NOT NULL,
+        nome_bruto    TEXT,
+        nome_limpo    TEXT,
+        sexo          TEXT,
+        nascimento    TEXT,
+        idade         INTEGER,
+        rua           TEXT,
+        numero        TEXT,
+        complemento   TEXT,
+        bairro        TEXT,
+        cidade        TEXT,
+        uf            TEXT,
+        cep           TEXT,
+        email         TEXT,
+        telefone      TEXT,
+        criado_em     TEXT,
+        nivel_atual   TEXT,
+        nivel_ordem   INTEGER
+    );
+"""
+
+_INSERT_CLIENTS_STAGE_SQL = f"""
+    INSERT INTO temp.clients_stage ({_CLIENT_COLS_SQL})
+    VALUES (
+        ?, ?, ?, ?, ?, ?,
+        ?, ?, ?, ?, ?, ?, ?,
+        ?, ?, ?, ?, ?
+    );
+"""
+
+# Nível mudou = difere da linha anterior do mesmo evo_id no lote ou, na
+# primeira, do nivel_ordem gravado em clients (roda ANTES do upsert)
+_INSERT_LEVEL_HISTORY_FROM_STAGE_SQL = """
+    INSERT INTO level_history (evo_id, data, nivel, nivel_ordem, origem)
+    SELECT evo_id, date('now', 'localtime'), nivel_atual, nivel_ordem, 'sync_clientes'
+    FROM (
+        SELECT
+            s.seq, s.evo_id, s.nivel_atual, s.nivel_ordem,
+            CASE WHEN LAG(s.seq) OVER w IS NULL THEN c.nivel_ordem
+                 ELSE LAG(s.nivel_ordem) OVER w
+            END AS ordem_anterior
+        FROM temp.clients_stage AS s
+        LEFT JOIN clients AS c ON c.evo_id = s.evo_id
+        WINDOW w AS (PARTITION BY s.evo_id ORDER BY s.seq)
+    )
+    WHERE nivel_ordem IS NOT NULL AND nivel_ordem IS NOT ordem_anterior
+    ORDER BY seq;
+"""
+
+_UPSERT_CLIENTS_FROM_STAGE_SQL = f"""
+    INSERT INTO clients ({_CLIENT_COLS_SQL}, updated_at)
+    SELECT {_CLIENT_COLS_SQL}, CURRENT_TIMESTAMP
+    FROM temp.clients_stage
+    WHERE true
+    ORDER BY seq
+    ON CONFLICT(evo_id) DO UPDATE SET
+        nome_bruto   = excluded.nome_bruto,
+        nome_limpo   = excluded.nome_limpo,
+        sexo         = excluded.sexo,
+        nascimento   = excluded.nascimento,
+        idade        = excluded.idade,
+        rua          = excluded.rua,
+        numero       = excluded.numero,
+        complemento  = excluded.complemento,
+        bairro       = excluded.bairro,
+        cidade       = excluded.cidade,
+        uf           = excluded.uf,
+        cep          = excluded.cep,
+        email        = excluded.email,
+        telefone     = excluded.telefone,
+        criado_em    = COALESCE(clients.criado_em, excluded.criado_em),
+        nivel_atual  = excluded.nivel_atual,
+        nivel_ordem  = excluded.nivel_ordem,
+        updated_at   = CURRENT_TIMESTAMP
+    -- sync repetido de clientes sem mudança não reescreve a linha (nem o WAL)
+    WHERE clients.nome_bruto  IS NOT excluded.nome_bruto
+       OR clients.nome_limpo  IS NOT excluded.nome_limpo
+       OR clients.sexo        IS NOT excluded.sexo
+       OR clients.nascimento  IS NOT excluded.nascimento
+       OR clients.idade       IS NOT excluded.idade
+       OR clients.rua         IS NOT excluded.rua
+       OR clients.numero      IS NOT excluded.numero
+       OR clients.complemento IS NOT excluded.complemento
+       OR clients.bairro      IS NOT excluded.bairro
+       OR clients.cidade      IS NOT excluded.cidade
+       OR clients.uf          IS NOT excluded.uf
+       OR clients.cep         IS NOT excluded.cep
+       OR clients.email       IS NOT excluded.email
+       OR clients.telefone    IS NOT excluded.telefone
+       OR (clients.criado_em IS NULL AND excluded.criado_em IS NOT NULL)
+       OR clients.nivel_atual IS NOT excluded.nivel_atual
+       OR clients.nivel_ordem IS NOT excluded.nivel_ordem;
+"""
+
+# Colunas do DF da página de clientes, na ordem de _CLIENT_COLS_SQL
+# (depois de evo_id, nome_bruto e nome_limpo)
+_CLIENT_DF_COLS = [
+    "Sexo", "Nascimento", "Idade",
+    "Rua", "Numero", "Complemento", "Bairro", "Cidade", "UF", "CEP",
+    "Email", "Telefone", "CriadoEm",
+]
+
+
 def sync_clients_from_df(df_clientes: pd.DataFrame) -> int:
     """
     Recebe o DF 'amigável' da página 2_Base_de_Clientes e
@@ -335,133 +648,78 @@ def sync_clients_from_df(df_clientes: pd.DataFrame) -> int:
 
     - Upsert na tabela clients
     - Se o nível mudou, grava uma linha em level_history
+    Tudo numa única transação, a partir de um lote numa tabela temporária.
     Retorna o número de clientes processados.
     """
     init_db_if_needed()
-    conn = get_connection()
-    cur = conn.cursor()
 
-    hoje = date.today().isoformat()
-
-    # Garante colunas esperadas existindo no DF
+    # Garante colunas esperadas existindo no DF (faltantes viram None)
     cols = df_clientes.columns
+    df = df_clientes.reindex(columns=_CLIENT_DF_COLS).astype(object)
+    df = df.where(df.notna(), None)
 
-    def get(row, col, default=None):
-        return row[col] if col in cols else default
+    if "IdCliente" in cols:
+        evo_ids = df_clientes["IdCliente"].astype(str).str.strip()
+    else:
+        evo_ids = pd.Series("", index=df_clientes.index)
 
-    processed = 0
+    # nome e nível extraídos da coluna inteira de uma vez
+    if "Nome" in cols:
+        nomes = df_clientes["Nome"].fillna("").astype(str).str.strip()
+    else:
+        nomes = pd.Series("", index=df_clientes.index)
+    niveis = _extract_niveis(nomes)
+
+    upserts = []
 
-    for _, row in df_clientes.iterrows():
-        evo_id = str(get(row, "IdCliente", "")).strip()
+    for evo_id, nome_bruto, nivel, rec in zip(evo_ids, nomes, niveis, df.itertuples(index=False, name=None)):
         if not evo_id:
             continue
-
-        nome_bruto = str(get(row, "Nome", "") or "").strip()
-        nome_limpo, nivel = _extract_nome_e_nivel(nome_bruto)
-        nivel_ordem = LEVEL_ORDER.get(nivel)
-
-        sexo = get(row, "Sexo")
-        nascimento = get(row, "Nascimento")
-        idade = get(row, "Idade")
-        rua = get(row, "Rua")
-        numero = get(row, "Numero")
-        compl = get(row, "Complemento")
-        bairro = get(row, "Bairro")
-        cidade = get(row, "Cidade")
-        uf = get(row, "UF")
-        cep = get(row, "CEP")
-        email = get(row, "Email")
-        tel = get(row, "Telefone")
-        criado_em = get(row, "CriadoEm")
-
-        # Nível anterior (se já existir cliente)
-        cur.execute(
-            "SELECT nivel_atual FROM clients WHERE evo_id = ?",
-            (evo_id,),
-        )
-        row_prev = cur.fetchone()
-        nivel_anterior = row_prev["nivel_atual"] if row_prev else None
-
-        # UPSERT do cliente
-        cur.execute(
-            """
-            INSERT INTO clients (
-                evo_id, nome_bruto, nome_limpo, sexo, nascimento, idade,
-                rua, numero, complemento, bairro, cidade, uf, cep,
-                email, telefone, criado_em, nivel_atual, nivel_ordem, updated_at
-            )
-            VALUES (
-                ?, ?, ?, ?, ?, ?,
-                ?, ?, ?, ?, ?, ?, ?,
-                ?, ?, ?, ?, ?, CURRENT_TIMESTAMP
-            )
-            ON CONFLICT(evo_id) DO UPDATE SET
-                nome_bruto   = excluded.nome_bruto,
-                nome_limpo   = excluded.nome_limpo,
-                sexo         = excluded.sexo,
-                nascimento   = excluded.nascimento,
-                idade        = excluded.idade,
-                rua          = excluded.rua,
-                numero       = excluded.numero,
-                complemento  = excluded.complemento,
-                bairro       = excluded.bairro,
-                cidade       = excluded.cidade,
-                uf           = excluded.uf,
-                cep          = excluded.cep,
-                email        = excluded.email,
-                telefone     = excluded.telefone,
-                criado_em    = COALESCE(clients.criado_em, excluded.criado_em),
-                nivel_atual  = excluded.nivel_atual,
-                nivel_ordem  = excluded.nivel_ordem,
-                updated_at   = CURRENT_TIMESTAMP;
-            """,
-            (
-                evo_id, nome_bruto, nome_limpo, sexo, nascimento, idade,
-                rua, numero, compl, bairro, cidade, uf, cep,
-                email, tel, criado_em, nivel, nivel_ordem
-            ),
-        )
-
-        # Se o nível mudou, grava histórico
-        if nivel and nivel != nivel_anterior:
-            cur.execute(
-                """
-                INSERT INTO level_history (evo_id, data, nivel, nivel_ordem, origem)
-                VALUES (?, ?, ?, ?, ?);
-                """,
-                (evo_id, hoje, nivel, nivel_ordem, "sync_clientes"),
-            )
-
-        processed += 1
-
-    conn.commit()
-    conn.close()
+        upserts.append((evo_id, nome_bruto, nome_bruto, *rec, nivel, LEVEL_ORDER.get(nivel)))
+
+    # histórico calculado no SQLite a partir do lote, antes do upsert
+    with _shared_connection() as conn, conn:
+        cur = conn.cursor()
+        cur.execute(_CREATE_CLIENTS_STAGE_SQL)
+        cur.execute("DELETE FROM temp.clients_stage;")
+        cur.executemany(_INSERT_CLIENTS_STAGE_SQL, upserts)
+        cur.execute(_INSERT_LEVEL_HISTORY_FROM_STAGE_SQL)
+        cur.execute(_UPSERT_CLIENTS_FROM_STAGE_SQL)
+        cur.execute("DELETE FROM temp.clients_stage;")
 
     # Backup manual: agora é feito via botão na página 98_Restaurar_DB_de_Backup
     # (não fazemos mais backup automático aqui para evitar sobrescrever dados bons
     # com estados intermediários ou ambientes vazios)
 
-    return processed
+    return len(upserts)
 # ---------------------------------------------------------------------------
 # Snapshot diário de quantidade de clientes
 # ---------------------------------------------------------------------------
 
+# novos = total - último snapshot anterior (nunca negativo)
+_UPSERT_DAILY_COUNT_SQL = """
+    INSERT INTO daily_clients (data, total_clientes, novos_clientes)
+    VALUES (
+        date('now', 'localtime'), ?,
+        MAX(? - COALESCE(
+            (SELECT total_clientes FROM daily_clients
+             WHERE data < date('now', 'localtime') ORDER BY data DESC LIMIT 1), 0), 0)
+    )
+    ON CONFLICT(data) DO UPDATE SET
+        total_clientes = excluded.total_clientes,
+        novos_clientes = excluded.novos_clientes;
+"""
+
+_SELECT_DAILY_COUNTS_SQL = """
+    SELECT data, total_clientes, novos_clientes
+    FROM daily_clients
+    ORDER BY data;
+"""
+
+
 def _ensure_daily_clients_table():
-    """Garante a existência da tabela de histórico diário."""
+    """Garante a existência da tabela de histórico diário (criada junto com o schema)."""
     init_db_if_needed()
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS daily_clients (
-            data TEXT PRIMARY KEY,
-            total_clientes INTEGER NOT NULL,
-            novos_clientes INTEGER NOT NULL
-        );
-        """
-    )
-    conn.commit()
-    conn.close()
 
 
 def register_daily_client_count(total_clientes: int) -> None:
@@ -470,36 +728,13 @@ def register_daily_client_count(total_clientes: int) -> None:
     Se já existir registro no dia, ATUALIZA o valor.
     """
     _ensure_daily_clients_table()
-    conn = get_connection()
-    cur = conn.cursor()
 
-    hoje = date.today().isoformat()
+    total = int(total_clientes)
 
-    # pega o último snapshot anterior
-    cur.execute(
-        "SELECT data, total_clientes FROM daily_clients WHERE data < ? ORDER BY data DESC LIMIT 1;",
-        (hoje,)
-    )
-    row = cur.fetchone()
-    last_total = row[1] if row else 0
-
-    novos = max(int(total_clientes) - int(last_total), 0)
-
-    # Se já existe registro pro dia, atualiza
-    cur.execute("SELECT 1 FROM daily_clients WHERE data = ?;", (hoje,))
-    if cur.fetchone():
-        cur.execute(
-            "UPDATE daily_clients SET total_clientes = ?, novos_clientes = ? WHERE data = ?;",
-            (int(total_clientes), int(novos), hoje)
-        )
-    else:
-        cur.execute(
-            "INSERT INTO daily_clients (data, total_clientes, novos_clientes) VALUES (?, ?, ?);",
-            (hoje, int(total_clientes), int(novos))
-        )
+    # upsert numa única instrução, sem corrida entre a checagem e o INSERT
+    with _shared_connection() as conn, conn:
+        conn.execute(_UPSERT_DAILY_COUNT_SQL, (total, total))
 
-    conn.commit()
-    conn.close()
     # Não fazemos mais backup automático aqui.
     # O snapshot diário continua sendo gravado na tabela daily_clients,
     # mas o backup completo do banco é feito manualmente via botão.
@@ -513,16 +748,12 @@ def load_daily_client_counts() -> pd.DataFrame:
     ordenado por data.
     """
     _ensure_daily_clients_table()
-    conn = get_connection()
-    df = pd.read_sql_query(
-        """
-        SELECT data, total_clientes, novos_clientes
-        FROM daily_clients
-        ORDER BY data;
-        """,
-        conn,
-        parse_dates=["data"],
+    with _read_connection() as conn:
+        rows = conn.execute(_SELECT_DAILY_COUNTS_SQL).fetchall()
+    df = pd.DataFrame.from_records(
+        [tuple(r) for r in rows],
+        columns=["data", "total_clientes", "novos_clientes"],
     )
-    conn.close()
+    # `data` é ISO (YYYY-MM-DD): formato fixo, sem inferência por linha
+    df["data"] = pd.to_datetime(df["data"], format="%Y-%m-%d", cache=True)
     return df
-
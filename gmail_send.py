@@ -2,18 +2,25 @@
 # Envia e-mail pela sua conta Gmail com anexo (usando Gmail API)
 
 import os
-import base64
+import io
+import functools
 from email.message import EmailMessage
 
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.http import MediaIoBaseUpload
 from google.auth.transport.requests import Request
 
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.send"]
 
 
-def _get_gmail_service():
+# As credenciais são carregadas uma vez por processo e o google-auth renova o
+# access token sozinho quando expira. O Resource do Gmail não é cacheado: o
+# httplib2.Http dentro dele não é thread-safe e cada sessão do Streamlit roda
+# na sua própria thread, então cada envio monta o seu
+@functools.lru_cache(maxsize=1)
+def _get_gmail_credentials():
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -34,8 +41,11 @@ def _get_gmail_service():
         with open("token.json", "w") as token:
             token.write(creds.to_json())
 
-    service = build("gmail", "v1", credentials=creds)
-    return service
+    return creds
+
+
+def _get_gmail_service():
+    return build("gmail", "v1", credentials=_get_gmail_credentials(), cache_discovery=False)
 
 
 def send_email_with_attachment(
@@ -67,8 +77,13 @@ def send_email_with_attachment(
         filename=filename,
     )
 
-    encoded_message = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-    send_body = {"raw": encoded_message}
-
-    sent = service.users().messages().send(userId="me", body=send_body).execute()
+    # Envia o RFC822 como upload de mídia (resumable, em blocos de 256 KB) em vez
+    # de re-codificar a mensagem inteira em base64 dentro do JSON ("raw")
+    media = MediaIoBaseUpload(
+        io.BytesIO(msg.as_bytes()),
+        mimetype="message/rfc822",
+        chunksize=256 * 1024,
+        resumable=True,
+    )
+    sent = service.users().messages().send(userId="me", body={}, media_body=media).execute()
     return sent.get("id")
@@ -10,10 +10,15 @@ import numpy as np
 import streamlit as st
 import plotly.express as px
 import requests
+from requests.adapters import HTTPAdapter
 import io
 import base64
+import functools
+import hashlib
+import random
 from time import sleep
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 from db import sync_clients_from_df, register_daily_client_count, load_daily_client_counts
 
@@ -39,8 +44,12 @@ if not EVO_USER or not EVO_TOKEN:
 # HELPERS API
 # ──────────────────────────────────────────────────────────────────────────────
 
+@functools.lru_cache(maxsize=16384)
 def _fix_mojibake(s: str) -> str:
-    """Corrige 'SÃ£o Paulo' → 'São Paulo' quando vier com encoding errado."""
+    """
+    Corrige 'SÃ£o Paulo' → 'São Paulo' quando vier com encoding errado.
+    Memoizada: bairros/cidades se repetem muito entre clientes (só chamar com str).
+    """
     if not isinstance(s, str) or not s:
         return s
     if "Ã" in s or "Õ" in s or "Â" in s:
@@ -51,10 +60,26 @@ def _fix_mojibake(s: str) -> str:
     return s
 
 
+# (campo, chaves aceitas em ordem de preferência) — street, number, ..., zip
+_ADDR_KEYS = (
+    ("street", "streetName", "publicPlace", "logradouro"),
+    ("number", "streetNumber", "numero"),
+    ("complement", "complemento"),
+    ("neighborhood", "bairro"),
+    ("city", "cidade"),
+    ("state", "uf", "stateCode", "stateInitials"),
+    ("zipCode", "cep", "postalCode"),
+)
+# número e CEP não passam pelo _fix_mojibake
+_ADDR_MOJIBAKE = (True, False, True, True, True, True, False)
+
+
 def _extract_address_any(c: dict):
     """
     Extrai endereço em vários formatos comuns do EVO.
     Retorna (street, number, complement, neighborhood, city, state, zip).
+    Prioriza o endereço aninhado (principal); só consulta os campos soltos
+    do cliente para o que vier vazio ali.
     """
     addr = c.get("addresses") or c.get("address") or []
     if isinstance(addr, dict):
@@ -67,43 +92,23 @@ def _extract_address_any(c: dict):
             if isinstance(a, dict) and str(a.get("isMain", "")).lower() in ("true", "1")
         ]
         cand = (main_list[0] if main_list else addr[0]) or {}
-    else:
-        cand = {}
-
-    flat = {
-        "street": c.get("street") or c.get("streetName") or c.get("publicPlace") or c.get("logradouro"),
-        "number": c.get("number") or c.get("streetNumber") or c.get("numero"),
-        "complement": c.get("complement") or c.get("complemento"),
-        "neighborhood": c.get("neighborhood") or c.get("bairro"),
-        "city": c.get("city") or c.get("cidade"),
-        "state": c.get("state") or c.get("uf") or c.get("stateCode") or c.get("stateInitials"),
-        "zipCode": c.get("zipCode") or c.get("cep") or c.get("postalCode"),
-    }
+        if not isinstance(cand, dict):
+            cand = {}
 
-    def pick(d: dict, *keys):
+    out = []
+    for keys, fix in zip(_ADDR_KEYS, _ADDR_MOJIBAKE):
+        v = None
         for k in keys:
-            v = d.get(k)
+            v = cand.get(k)
             if v not in (None, "", []):
-                return v
-        return ""
-
-    street = pick(cand, "street", "streetName", "publicPlace", "logradouro") or flat["street"] or ""
-    number = pick(cand, "number", "streetNumber", "numero") or flat["number"] or ""
-    compl  = pick(cand, "complement", "complemento") or flat["complement"] or ""
-    neighb = pick(cand, "neighborhood", "bairro") or flat["neighborhood"] or ""
-    city   = pick(cand, "city", "cidade") or flat["city"] or ""
-    state  = pick(cand, "state", "uf", "stateCode", "stateInitials") or flat["state"] or ""
-    zipc   = pick(cand, "zipCode", "cep", "postalCode") or flat["zipCode"] or ""
-
-    street = _fix_mojibake(str(street).strip())
-    number = str(number).strip()
-    compl  = _fix_mojibake(str(compl).strip())
-    neighb = _fix_mojibake(str(neighb).strip())
-    city   = _fix_mojibake(str(city).strip())
-    state  = _fix_mojibake(str(state).strip())
-    zipc   = str(zipc).strip()
+                break
+        if not v:
+            # fallback: campos soltos no próprio cliente
+            v = next((c.get(k) for k in keys if c.get(k)), "")
+        v = str(v or "").strip()
+        out.append(_fix_mojibake(v) if fix else v)
 
-    return street, number, compl, neighb, city, state, zipc
+    return tuple(out)
 
 
 def _auth_header_basic():
@@ -112,29 +117,46 @@ def _auth_header_basic():
     return {"Authorization": f"Basic {b64}"}
 
 
-def _get_json(url_base, path, params=None):
+@st.cache_resource(show_spinner=False)
+def _evo_session():
     """
-    GET genérico com Basic Auth + backoff.
-    Agora com diagnóstico (status/erro final) para facilitar debug no Streamlit Cloud.
+    Session única (por processo) para a EVO: reaproveita conexões TCP/TLS
+    entre paginação e detalhes. Retry continua manual em _get_json.
     """
-    url = f"{url_base.rstrip('/')}/{path.lstrip('/')}"
-    headers = {
+    sess = requests.Session()
+    sess.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+    sess.headers.update({
         "Accept": "application/json",
         "User-Agent": "BornToSkiDashboard/1.0 (+streamlit)",
         **_auth_header_basic(),
-    }
+    })
+    return sess
+
+
+def _get_json(url_base, path, params=None, initial_backoff=0.1, max_retries=3):
+    """
+    GET genérico com Basic Auth + backoff exponencial com jitter
+    (initial_backoff · 2^tentativa, teto de 8s).
+    Agora com diagnóstico (status/erro final) para facilitar debug no Streamlit Cloud.
+    """
+    url = f"{url_base.rstrip('/')}/{path.lstrip('/')}"
+    sess = _evo_session()
     params = params or {}
 
-    backoff = 1.0
     last_exc = None
     last_status = None
     last_text = None
 
-    for attempt in range(1, 7):
+    def _wait(attempt):
+        if attempt + 1 >= max_retries:
+            return  # última tentativa: não dorme à toa
+        backoff = initial_backoff * (2 ** attempt) + random.uniform(0, initial_backoff)
+        sleep(min(backoff, 8))
+
+    for attempt in range(max_retries):
         try:
-            r = requests.get(
+            r = sess.get(
                 url,
-                headers=headers,
                 params=params,
                 verify=VERIFY_SSL,
                 timeout=60,
@@ -168,8 +190,7 @@ def _get_json(url_base, path, params=None):
 
             # Erros transitórios: retry com backoff
             if r.status_code in (429, 500, 502, 503, 504):
-                sleep(backoff)
-                backoff = min(backoff * 2, 8)
+                _wait(attempt)
                 continue
 
             # Outros erros: já explode com contexto
@@ -181,8 +202,7 @@ def _get_json(url_base, path, params=None):
 
         except requests.RequestException as e:
             last_exc = e
-            sleep(backoff)
-            backoff = min(backoff * 2, 8)
+            _wait(attempt)
 
     # Se chegou aqui, foi timeout/conexão/etc em todas as tentativas
     raise RuntimeError(
@@ -193,14 +213,57 @@ def _get_json(url_base, path, params=None):
     )
 
 @st.cache_data(show_spinner=False, ttl=600)
-def _cached_get_v2(path: str, params_tuple):
+def _cached_get_v2(path: str, params_tuple, max_retries=3):
     params = dict(params_tuple)
-    return _get_json(BASE_URL_V2, path, params=params)
+    return _get_json(BASE_URL_V2, path, params=params, max_retries=max_retries)
+
+
+# paginação do /members é o endpoint mais instável: só ela usa mais tentativas
+_MEMBERS_MAX_RETRIES = 6
+
+
+def _v2(path: str, max_retries=3, **params):
+    """GET v2 cacheado com chave estável (parâmetros ordenados por nome)."""
+    return _cached_get_v2(path, tuple(sorted(params.items())), max_retries=max_retries)
 
 
 def _get_json_v1(path, params=None):
     return _get_json(BASE_URL_V1, path, params=params)
 
+_DETAIL_WORKERS = 8
+
+
+def _slot_member_ids(item):
+    """
+    IDs dos inscritos quando o item de activities/schedule os expõe
+    (enrollments / enrolledMembers / members); None se a agenda não trouxer
+    ou se algum inscrito vier sem ID utilizável (lista vazia também conta como
+    "não sei", para não podar à toa).
+    """
+    for key in ("enrollments", "enrolledMembers", "members"):
+        lst = item.get(key)
+        if isinstance(lst, list):
+            ids = set()
+            for en in lst:
+                raw = en
+                if isinstance(en, dict):
+                    raw = next(
+                        (en[k] for k in ("idMember", "memberId", "id") if en.get(k) is not None),
+                        None,
+                    )
+                try:
+                    id_member = int(raw)
+                except (TypeError, ValueError):
+                    # inscrito sem ID: não dá pra afirmar que o cliente não está na aula
+                    return None
+                if id_member <= 0:
+                    return None
+                ids.add(id_member)
+            if ids:
+                return ids
+    return None
+
+
 @st.cache_data(show_spinner=False, ttl=300)
 def fetch_member_activities_history(
     id_cliente: str,
@@ -216,7 +279,6 @@ def fetch_member_activities_history(
     Retorna uma lista de dicts pronta para virar DataFrame/tabela.
     """
     from datetime import datetime, date, timedelta
-    import requests
 
     if not id_cliente:
         return []
@@ -233,11 +295,9 @@ def fetch_member_activities_history(
     # helper interno: pega o JSON cru do v1 (sem achatar em lista)
     def _get_json_v1_raw(path: str, params=None):
         url = f"{BASE_URL_V1.rstrip('/')}/{path.lstrip('/')}"
-        headers = {"Accept": "application/json", **_auth_header_basic()}
         try:
-            r = requests.get(
+            r = _evo_session().get(
                 url,
-                headers=headers,
                 params=params or {},
                 verify=VERIFY_SSL,
                 timeout=60,
@@ -298,6 +358,12 @@ def fetch_member_activities_history(
                 continue
             seen_slots.add(slot_key)
 
+            # se a agenda já trouxer os inscritos, nem busca o detalhe de
+            # aulas em que o cliente não está (sem a lista, segue pro detalhe)
+            inscritos = _slot_member_ids(it)
+            if inscritos is not None and id_member not in inscritos:
+                continue
+
             schedule_slots.append(
                 {
                     "idConfiguration": int(id_conf),
@@ -308,20 +374,23 @@ def fetch_member_activities_history(
 
         current += step
 
+    def _fetch_detail(slot):
+        detail_params = {
+            "idConfiguration": slot["idConfiguration"],
+            "activityDate": slot["date"].isoformat(),
+        }
+        return slot, _get_json_v1_raw("activities/schedule/detail", params=detail_params)
+
     rows = []
 
-    for slot in schedule_slots:
-        id_conf = slot["idConfiguration"]
+    # um GET de detalhe por slot: só IO, então busca em paralelo
+    with ThreadPoolExecutor(max_workers=_DETAIL_WORKERS) as pool:
+        details = list(pool.map(_fetch_detail, schedule_slots))
+
+    for slot, detail in details:
         dt_iso  = slot["date"]
         raw     = slot["raw"]
 
-        detail_params = {
-            "idConfiguration": id_conf,
-            "activityDate": dt_iso.isoformat(),
-        }
-
-        detail = _get_json_v1_raw("activities/schedule/detail", params=detail_params)
-
         # se por algum motivo veio lista ou vazio, pula
         if not isinstance(detail, dict):
             continue
@@ -374,57 +443,111 @@ def fetch_member_activities_history(
     rows.sort(key=lambda r: (r["Data"], r["Horário"]))
     return rows
 
+# Páginas do /members buscadas em paralelo (rede é o gargalo, threads bastam).
+# No máximo _MEMBERS_WORKERS requisições em voo e uma pausa entre blocos,
+# no lugar do sleep(0.2) por página: não depende só do retry de 429.
+_MEMBERS_WORKERS = 4
+_MEMBERS_BLOCK_PAUSE = 0.2
+
+
 def fetch_members_v2_all(take=100, showMemberships=True, includeAddress=True, includeContacts=True, debug=False):
     take = min(max(1, int(take)), 100)
+    flags = {
+        "showMemberships": "true" if showMemberships else "false",
+        "includeAddress": "true" if includeAddress else "false",
+        "includeContacts": "true" if includeContacts else "false",
+    }
+
+    def _page(skip):
+        return _v2("members", max_retries=_MEMBERS_MAX_RETRIES, take=take, skip=skip, **flags)
+
     skip = 0
     all_rows = []
+    erro = None  # (skip, exceção) da primeira página que falhou
 
-    while True:
-        params = {
-            "take": take,
-            "skip": skip,
-            "showMemberships": "true" if showMemberships else "false",
-            "includeAddress": "true" if includeAddress else "false",
-            "includeContacts": "true" if includeContacts else "false",
-        }
+    # dispara blocos de páginas especulativamente e para na primeira vazia/curta
+    with ThreadPoolExecutor(max_workers=_MEMBERS_WORKERS) as pool:
+        while True:
+            skips = [skip + i * take for i in range(_MEMBERS_WORKERS)]
+            futures = [pool.submit(_page, s) for s in skips]
+            fim = False
 
-        try:
-            batch = _cached_get_v2("members", tuple(params.items()))
-        except RuntimeError as e:
-            # 👇 diagnóstico objetivo para você e para o suporte
-            st.error(f"❌ EVO v2/members retornou erro nesta página: take={take} skip={skip}")
-            st.code(f"Params: {params}", language="text")
-            if debug:
-                st.exception(e)
+            for s, fut in zip(skips, futures):
+                try:
+                    batch = fut.result()
+                except RuntimeError as e:
+                    erro = (s, e)
+                    break
 
-            # 👇 tentativa automática de contorno: reduzir payload
-            if includeContacts or includeAddress or showMemberships:
-                st.warning("Tentando novamente com payload reduzido (sem contacts/address/memberships)…")
-                return fetch_members_v2_all(
-                    take=take,
-                    showMemberships=False,
-                    includeAddress=False,
-                    includeContacts=False,
-                    debug=debug,
-                )
+                if not batch:
+                    fim = True
+                    break
 
-            # se até no payload reduzido deu erro, para geral
-            raise
+                all_rows.extend(batch)
 
-        if not batch:
-            break
+                # se veio menos que take, acabou
+                if isinstance(batch, list) and len(batch) < take:
+                    fim = True
+                    break
 
-        all_rows.extend(batch)
-        skip += take
+            if fim or erro:
+                # não inicia o que sobrou do bloco; o que já está em voo termina
+                # ao sair do `with`, e nenhum bloco novo é disparado
+                for f in futures:
+                    f.cancel()
+                break
+
+            skip += take * _MEMBERS_WORKERS
+            sleep(_MEMBERS_BLOCK_PAUSE)
+
+    if erro is None:
+        return all_rows
+
+    # pool já encerrado: daqui pra baixo nenhuma requisição do payload cheio
+    s, e = erro
+    # 👇 diagnóstico objetivo para você e para o suporte
+    st.error(f"❌ EVO v2/members retornou erro nesta página: take={take} skip={s}")
+    st.code(f"Params: {dict(take=take, skip=s, **flags)}", language="text")
+    if debug:
+        st.exception(e)
+
+    # 👇 tentativa automática de contorno: reduzir payload
+    if includeContacts or includeAddress or showMemberships:
+        st.warning("Tentando novamente com payload reduzido (sem contacts/address/memberships)…")
+        return fetch_members_v2_all(
+            take=take,
+            showMemberships=False,
+            includeAddress=False,
+            includeContacts=False,
+            debug=debug,
+        )
+
+    # se até no payload reduzido deu erro, para geral
+    raise e
+
+def _df_signature(df):
+    """Chave barata para o cache dos downloads (sensível à ordem das linhas)."""
+    try:
+        h = pd.util.hash_pandas_object(df, index=False)
+    except TypeError:
+        # base bruta tem listas/dicts aninhados, que não são hasheáveis
+        h = pd.util.hash_pandas_object(df.astype(str), index=False)
+    return df.shape, tuple(df.columns), hashlib.md5(h.to_numpy().tobytes()).hexdigest()
 
-        # se veio menos que take, acabou
-        if isinstance(batch, list) and len(batch) < take:
-            break
 
-        sleep(0.2)
+_DF_HASH_FUNCS = {pd.DataFrame: _df_signature}
 
-    return all_rows
 
+@st.cache_data(show_spinner=False, ttl=600, max_entries=16, hash_funcs=_DF_HASH_FUNCS)
+def _csv_bytes(df):
+    # BOM (Excel) escrito uma vez; pandas grava em blocos direto no buffer binário
+    buf = io.BytesIO()
+    buf.write(b"\xef\xbb\xbf")
+    df.to_csv(buf, index=False, encoding="utf-8", chunksize=50_000)
+    return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, ttl=600, max_entries=16, hash_funcs=_DF_HASH_FUNCS)
 def _excel_bytes(df, sheet_name="Sheet1"):
     buf = io.BytesIO()
     try:
@@ -439,6 +562,23 @@ def _excel_bytes(df, sheet_name="Sheet1"):
             df.to_excel(writer, index=False, sheet_name=sheet_name)
     return buf.getvalue()
 
+def _xlsx_sob_demanda(df, label, file_name, sheet_name, key, prep_label):
+    """
+    Só monta o XLSX (caro) depois do clique em `prep_label`; o botão de
+    download vale enquanto o conteúdo do df não mudar (novo filtro = novo clique).
+    """
+    sig = _df_signature(df)
+    if st.session_state.get(key) != sig:
+        if not st.button(prep_label, key=f"{key}_btn"):
+            return
+        st.session_state[key] = sig
+    st.download_button(
+        label,
+        _excel_bytes(df, sheet_name),
+        file_name,
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
 # ──────────────────────────────────────────────────────────────────────────────
 # NOME + NÍVEL
 # ──────────────────────────────────────────────────────────────────────────────
@@ -451,6 +591,11 @@ LEVEL_ORDER_MAP = {
     "4A": 40, "4B": 41, "4C": 42, "4D": 43,
 }
 
+# encontra "2B", "2 B", "1BSK", "2CSB", "3A.", "4C+"
+_LEVEL_RE = re.compile(r"[1-4]\s*[A-D]")
+# remove "1B", "1BSK", "1BSKI", "1BSB", etc. numa única passada
+_LEVEL_STRIP_RE = re.compile(r"\b[1-4][A-D](?:SKI?|SBI?)?\b", re.IGNORECASE)
+
 
 def split_nome_e_nivel(nome: str):
     """
@@ -472,40 +617,20 @@ def split_nome_e_nivel(nome: str):
     if not nome:
         return "", None, None
 
-    import re
-
     nome_str = str(nome).strip()
-    upper = nome_str.upper()
-
-    # encontra "2B", "2 B", "1BSK", "2CSB", "3A.", "4C+"
-    pattern = r"([1-4]\s*[A-D])"
-    matches = re.findall(pattern, upper)
-
-    if not matches:
-        return nome_str, None, None
-
-    # normaliza "2 B" -> "2B"
-    matches = [m.replace(" ", "") for m in matches]
 
-    # filtra só níveis válidos
+    # normaliza "2 B" -> "2B" e filtra só níveis válidos
+    matches = [m.replace(" ", "") for m in _LEVEL_RE.findall(nome_str.upper())]
     matches = [m for m in matches if m in LEVEL_ORDER_MAP]
     if not matches:
         return nome_str, None, None
 
     # melhor nível
-    best = max(matches, key=lambda x: LEVEL_ORDER_MAP.get(x, -1))
-    nivel_atual = best
-    nivel_ordem = LEVEL_ORDER_MAP.get(best)
+    nivel_atual = max(matches, key=LEVEL_ORDER_MAP.get)
+    nivel_ordem = LEVEL_ORDER_MAP[nivel_atual]
 
-    # remove todos os códigos do nome, inclusive casos colados com SK/SB
-    nome_limpo = nome_str
-    for code in set(matches):
-        # remove "1B", "1BSK", "1BSKI", "1BSB", etc
-        padrao_remocao = r'\b' + re.escape(code) + r'(?:SKI?|SBI?)?\b'
-        nome_limpo = re.sub(padrao_remocao, '', nome_limpo, flags=re.IGNORECASE)
-
-    # limpa espaços extras
-    nome_limpo = re.sub(r'\s+', ' ', nome_limpo).strip()
+    # remove todos os códigos do nome e limpa espaços extras
+    nome_limpo = " ".join(_LEVEL_STRIP_RE.sub("", nome_str).split())
 
     return nome_limpo, nivel_atual, nivel_ordem
 
@@ -514,25 +639,66 @@ def split_nome_e_nivel(nome: str):
 # ──────────────────────────────────────────────────────────────────────────────
 
 
+_SEXO_MAP = {
+    "m": "Masculino", "masc": "Masculino", "masculino": "Masculino", "male": "Masculino",
+    "f": "Feminino", "fem": "Feminino", "feminino": "Feminino", "female": "Feminino",
+}
+_EMAIL_TYPES = ("EMAIL", "E-MAIL", "MAIL")
+_PHONE_TYPES = ("MOBILE", "CELULAR", "CELLPHONE", "PHONE", "TELEFONE")
+_HAS_DIGIT_RE = re.compile(r"\d")
+_ARROW_STR_COLS = ("Sexo", "Bairro", "Cidade", "UF")
+
+
+def _clean_email(v: str) -> str:
+    v = str(v or "").strip()
+    return v if "@" in v and "." in v.split("@")[-1] else ""
+
+
+def _parse_dates(values):
+    """
+    Converte datas em lote com pd.to_datetime; o que o pandas não entender
+    (formatos estranhos, fusos misturados) cai no dateutil, como antes.
+    Retorna Series de datetime.date (ou None).
+    """
+    raw = pd.Series(values, dtype=object)
+    try:
+        dt = pd.to_datetime(raw, errors="coerce", format="mixed")
+        if dt.dt.tz is not None:
+            dt = dt.dt.tz_localize(None)
+        out = dt.dt.date.astype(object).where(dt.notna(), None)
+    except Exception:
+        out = pd.Series(None, index=raw.index, dtype=object)
+
+    def _fallback(v):
+        try:
+            return parse_date(v).date()
+        except Exception:
+            return None
+
+    miss = out.isna() & raw.notna()
+    if miss.any():
+        out[miss] = raw[miss].map(_fallback)
+    return out
+
+
 def _normalize_members_basic(raw_list):
-    def _clean_phone(v: str) -> str:
-        if not v:
-            return ""
-        digits = re.sub(r"\D", "", str(v))
-        if digits.startswith("55"):
-            return "+" + digits
-        if len(digits) in (10, 11):
-            return "+55" + digits
-        return "+" + digits if digits else ""
-
-    def _clean_email(v: str) -> str:
-        v = str(v or "").strip()
-        return v if "@" in v and "." in v.split("@")[-1] else ""
+    """
+    Loop Python só para o que precisa andar no dict (id, nome, contatos,
+    endereço); sexo, datas, e-mail e telefone são tratados depois, por coluna.
+    """
+    cols = {k: [] for k in (
+        "IdCliente", "Nome", "NomeLimpo", "NivelAtual", "NivelOrdem", "Sexo",
+        "Nascimento", "Idade", "Rua", "Numero", "Complemento", "Bairro", "Cidade",
+        "UF", "CEP", "EnderecoLinha", "Email", "Telefone", "CriadoEm",
+    )}
+    email_ct = []
+    tel_ct = []
 
-    out = []
     seen = set()
     for c in raw_list:
         cid = c.get("idMember") or c.get("memberId") or c.get("id") or c.get("Id")
+        # normaliza para str: 123 e "123" são o mesmo cliente
+        cid = str(cid) if cid is not None else ""
         if cid in seen:
             continue
         seen.add(cid)
@@ -548,109 +714,226 @@ def _normalize_members_basic(raw_list):
         sx = c.get("gender") or c.get("sexo") or c.get("sex") or ""
         if isinstance(sx, dict):
             sx = sx.get("name") or sx.get("description") or ""
-        sxn = str(sx).strip().lower()
-        if sxn in ("m", "masc", "masculino", "male"):
-            sexo_fmt = "Masculino"
-        elif sxn in ("f", "fem", "feminino", "female"):
-            sexo_fmt = "Feminino"
-        elif sxn:
-            sexo_fmt = sxn.capitalize()
-        else:
-            sexo_fmt = "Não informado"
 
-        nascimento = None
-        idade = None
         b = c.get("birthDate") or c.get("birthday") or c.get("dtBirth")
-        if b:
-            try:
-                dtn = parse_date(str(b)).date()
-                nascimento = dtn.isoformat()
-                idade = int((date.today() - dtn).days // 365.25)
-                if idade < 0 or idade > 120:
-                    idade = None
-            except Exception:
-                pass
-
-        email = _clean_email(c.get("email") or "")
-        tel = _clean_phone(c.get("phone") or c.get("mobile") or c.get("cellphone") or "")
 
         # Também lê telefones/e-mails da lista de contatos vinda da EVO
+        # (guarda o 1º candidato válido; a escolha final é feita por coluna)
+        email_c = ""
+        tel_c = ""
         for ct in (c.get("contacts") or []):
+            if email_c and tel_c:
+                break
             # Em alguns exports o campo vem como "type", em outros como "contactType"
-            raw_type = ct.get("type") or ct.get("contactType") or ""
-            t = str(raw_type).upper()
+            t = str(ct.get("type") or ct.get("contactType") or "").upper()
 
             # Número / e-mail podem vir em "value" ou "description"
-            v = ct.get("value") or ct.get("description") or ""
-            v = str(v).strip()
+            v = str(ct.get("value") or ct.get("description") or "").strip()
             if not v:
                 continue
 
-            # DDI pode vir separado (ex: "55")
-            ddi = str(ct.get("ddi") or "").strip()
-
             # E-mail
-            if not email and t in ("EMAIL", "E-MAIL", "MAIL"):
-                email = _clean_email(v)
-
-            # Celular/telefone
-            if not tel and t in ("MOBILE", "CELULAR", "CELLPHONE", "PHONE", "TELEFONE"):
-                num = v
-                # Se tiver DDI separado, junta antes de limpar
-                if ddi and not num.startswith("+"):
-                    num = ddi + num
-                tel = _clean_phone(num)
+            if not email_c and t in _EMAIL_TYPES:
+                email_c = _clean_email(v)
 
+            # Celular/telefone — DDI pode vir separado (ex: "55")
+            if not tel_c and t in _PHONE_TYPES:
+                ddi = str(ct.get("ddi") or "").strip()
+                num = ddi + v if ddi and not v.startswith("+") else v
+                if _HAS_DIGIT_RE.search(num):
+                    tel_c = num
 
         street, number, compl, bairro, cidade, uf, cep = _extract_address_any(c)
 
         criado = c.get("createdAt") or c.get("creationDate") or ""
-        if criado:
+
+        cols["IdCliente"].append(cid)
+        cols["Nome"].append(nome_bruto)
+        cols["NomeLimpo"].append(nome_limpo)
+        cols["NivelAtual"].append(nivel_atual)
+        cols["NivelOrdem"].append(nivel_ordem)
+        cols["Sexo"].append(sx)
+        cols["Nascimento"].append(str(b) if b else None)
+        cols["Idade"].append(None)
+        cols["Rua"].append(street)
+        cols["Numero"].append(number)
+        cols["Complemento"].append(compl)
+        cols["Bairro"].append(bairro)
+        cols["Cidade"].append(cidade)
+        cols["UF"].append(uf)
+        cols["CEP"].append(cep)
+        cols["EnderecoLinha"].append(
+            " | ".join([x for x in [street, number, compl, bairro, cidade, uf, cep] if x])
+        )
+        cols["Email"].append(c.get("email") or "")
+        cols["Telefone"].append(c.get("phone") or c.get("mobile") or c.get("cellphone") or "")
+        cols["CriadoEm"].append(criado)
+        email_ct.append(email_c)
+        tel_ct.append(tel_c)
+
+    if not seen:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(cols)
+
+    # Nascimento / Idade (fora de 0–120 anos vira vazio)
+    nasc = _parse_dates(df["Nascimento"])
+    dias = (pd.Timestamp(date.today()) - pd.to_datetime(nasc, errors="coerce")).dt.days
+    idade = dias // 365.25
+    df["Nascimento"] = nasc.map(lambda d: d.isoformat() if d else None)
+    df["Idade"] = idade.where(idade.between(0, 120))
+
+    # CriadoEm: ISO quando der para interpretar, senão mantém o valor original
+    criado_raw = df["CriadoEm"]
+    criado = _parse_dates(criado_raw.where(criado_raw != "", None).map(lambda v: str(v) if v else None))
+    df["CriadoEm"] = criado.map(lambda d: d.isoformat() if d else None).fillna(criado_raw)
+
+    # Sexo: mapeia variações conhecidas; o resto vai capitalizado
+    sxn = df["Sexo"].astype(str).str.strip().str.lower()
+    df["Sexo"] = sxn.map(_SEXO_MAP).fillna(sxn.str.capitalize()).where(sxn != "", "Não informado")
+
+    # E-mail: principal se válido (tem "@" e "." depois do último "@"), senão o dos contatos
+    email = df["Email"].astype(str).str.strip()
+    df["Email"] = email.where(email.str.contains(r"@[^@]*\.[^@]*$", na=False), pd.Series(email_ct, index=df.index))
+
+    # Telefone: só dígitos do principal, senão do contato; prefixa +55 quando faltar DDI
+    digits = df["Telefone"].astype(str).str.replace(r"\D", "", regex=True)
+    digits_ct = pd.Series(tel_ct, index=df.index).str.replace(r"\D", "", regex=True)
+    digits = digits.where(digits != "", digits_ct)
+    n = digits.str.len()
+    df["Telefone"] = np.select(
+        [digits.str.startswith("55"), n.isin((10, 11)), n > 0],
+        ["+" + digits, "+55" + digits, "+" + digits],
+        default="",
+    )
+
+    # colunas de filtro/contagem em string[pyarrow]: isin/value_counts rodam no
+    # kernel de hash do Arrow. No pandas 3 o dtype str padrão já é Arrow.
+    for col in _ARROW_STR_COLS:
+        if pd.api.types.is_object_dtype(df[col]):
             try:
-                criado = parse_date(str(criado)).date().isoformat()
-            except Exception:
-                pass
-
-        out.append({
-            "IdCliente": str(cid) if cid is not None else "",
-            "Nome": nome_bruto,
-            "NomeLimpo": nome_limpo,
-            "NivelAtual": nivel_atual,
-            "NivelOrdem": nivel_ordem,
-            "Sexo": sexo_fmt,
-            "Nascimento": nascimento,
-            "Idade": idade,
-            "Rua": street,
-            "Numero": number,
-            "Complemento": compl,
-            "Bairro": bairro,
-            "Cidade": cidade,
-            "UF": uf,
-            "CEP": cep,
-            "EnderecoLinha": " | ".join([x for x in [street, number, compl, bairro, cidade, uf, cep] if x]),
-            "Email": email,
-            "Telefone": tel,
-            "CriadoEm": criado,
-        })
-
-    return pd.DataFrame(out)
+                df[col] = df[col].astype("string[pyarrow]")
+            except ImportError:
+                break
+
+    return df
 
 # ──────────────────────────────────────────────────────────────────────────────
 # CACHES / INVALIDAÇÃO
 # ──────────────────────────────────────────────────────────────────────────────
 
+@st.cache_resource(show_spinner=False, ttl=600)
+def _raw_clients_v2(bring_all, take, max_pages, memberships, address, contacts, debug=False):
+    """
+    Lista crua do EVO compartilhada entre sessões (cache_resource não faz
+    hash do conteúdo nem copia). Retorna (raw, coletado_em).
+    Atenção: vale para todos os usuários e expira em 10 min; o botão
+    "Atualizar clientes agora" recoleta para todos. `debug` entra na chave
+    para que ligar o debug de paginação realmente refaça a coleta.
+    """
+    from datetime import datetime as _dt
+
+    if bring_all:
+        raw = fetch_members_v2_all(
+            take=100,
+            showMemberships=memberships,
+            includeAddress=address,
+            includeContacts=contacts,
+            debug=debug,
+        )
+    else:
+        raw = []
+        skip = 0
+        for _ in range(max_pages):
+            batch = _v2(
+                "members",
+                max_retries=_MEMBERS_MAX_RETRIES,
+                take=take,
+                skip=skip,
+                showMemberships="true",
+                includeAddress="true",
+                includeContacts="true",
+            )
+            if not batch:
+                break
+            raw.extend(batch)
+            skip += take
+    return raw, _dt.now()
+
+
+@st.cache_data(show_spinner=False, ttl=600)
+def _normalize_members_basic_cached(raw_sig, _raw_list):
+    # _raw_list não entra no hash: a chave é a assinatura barata da coleta
+    return _normalize_members_basic(_raw_list)
+
+
+def _flatten_members(raw_list, sep="__"):
+    """
+    Achata o JSON cru pelo PyArrow (colunar, inferência sobre todas as linhas);
+    listas aninhadas continuam como listas Python, igual ao json_normalize.
+    Cai no pd.json_normalize se o Arrow não aceitar (tipos conflitantes etc.).
+    """
+    try:
+        import pyarrow as pa
+
+        tbl = pa.Table.from_struct_array(pa.array(raw_list))
+        while any(pa.types.is_struct(f.type) for f in tbl.schema):
+            tbl = tbl.flatten()
+        tbl = tbl.rename_columns([c.replace(".", sep) for c in tbl.column_names])
+
+        df = tbl.to_pandas()
+        for f in tbl.schema:
+            if pa.types.is_list(f.type) or pa.types.is_large_list(f.type):
+                df[f.name] = tbl.column(f.name).to_pylist()
+        return df
+    except Exception:
+        return pd.json_normalize(raw_list, sep=sep)
+
+
+@st.cache_data(show_spinner=False, ttl=600)
+def _raw_top_keys(raw_sig, _raw_list):
+    """Chaves de 1º nível presentes na coleta, na ordem em que aparecem."""
+    keys = {}
+    for c in _raw_list:
+        keys.update(dict.fromkeys(c))
+    return list(keys)
+
+
+@st.cache_data(show_spinner=False, ttl=600)
+def _full_frame(raw_sig, keys, _raw_list):
+    # keys vazio = todas; senão só achata os campos escolhidos
+    if keys:
+        _raw_list = [{k: c[k] for k in keys if k in c} for c in _raw_list]
+    return _flatten_members(_raw_list)
+
+
+@st.cache_data(show_spinner=False, ttl=600)
+def _criado_dates(raw_sig, _dfc):
+    """CriadoEm já convertido (datetime64[D], NaT se vazio/inválido), uma vez por coleta."""
+    return pd.to_datetime(_dfc["CriadoEm"], errors="coerce", format="mixed").to_numpy(dtype="datetime64[D]")
+
+
+_SEARCH_COLS = ["IdCliente", "Nome", "NomeLimpo", "Email", "Telefone"]
+
+
 @st.cache_data(show_spinner=False, ttl=600)
-def _normalize_members_basic_cached(raw_list):
-    return _normalize_members_basic(raw_list)
+def _search_index(raw_sig, _dfc):
+    """Uma coluna minúscula 'id|nome|nome limpo|email|telefone' por cliente."""
+    presentes = [c for c in _SEARCH_COLS if c in _dfc.columns]
+    if not presentes:
+        return None
+    idx = _dfc[presentes[0]].fillna("").astype(str)
+    for c in presentes[1:]:
+        idx = idx + "|" + _dfc[c].fillna("").astype(str)
+    return idx.str.lower()
 
 
 def _invalidate_cache():
     _cached_get_v2.clear()
+    _raw_clients_v2.clear()
     _normalize_members_basic_cached.clear()
-    st.session_state.pop("_clientes_raw", None)
-    st.session_state.pop("_clientes_df", None)
+    _full_frame.clear()
     st.session_state.pop("_clientes_full_df", None)
-    st.session_state.pop("__last_updated__", None)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # UI — Coleta de clientes
@@ -671,51 +954,26 @@ with st.sidebar:
         _invalidate_cache()
 
 # Coleta de clientes do EVO
-if "_clientes_raw" not in st.session_state:
-    with st.spinner("Coletando clientes do EVO (v2/members)…"):
-        if bring_all:
-            raw = fetch_members_v2_all(
-                take=100,
-                showMemberships=opt_memberships,
-                includeAddress=opt_address,
-                includeContacts=opt_contacts,
-                debug=debug_pages,
-            )
-        else:
-            rows = []
-            skip = 0
-            for _ in range(max_pages):
-                params = {
-                    "take": take,
-                    "skip": skip,
-                    "showMemberships": "true",
-                    "includeAddress": "true",
-                    "includeContacts": "true",
-                }
-                batch = _cached_get_v2("members", tuple(params.items()))
-                if not batch:
-                    break
-                rows.extend(batch)
-                skip += take
-            raw = rows
-        st.session_state["_clientes_raw"] = raw
-        from datetime import datetime as _dt
-        st.session_state["__last_updated__"] = _dt.now().strftime("%d/%m/%Y %H:%M")
-
-raw = st.session_state.get("_clientes_raw", [])
+with st.spinner("Coletando clientes do EVO (v2/members)…"):
+    raw, coletado_em = _raw_clients_v2(
+        bring_all, take, max_pages, opt_memberships, opt_address, opt_contacts, debug=debug_pages,
+    )
 st.success(f"Clientes carregados: {len(raw)}")
 
-# Normalização amigável
-if "_clientes_df" not in st.session_state:
-    st.session_state["_clientes_df"] = _normalize_members_basic_cached(raw)
-
-dfc = st.session_state["_clientes_df"].copy()
+# Normalização amigável (cache_data já devolve uma cópia por chamada)
+clientes_sig = (coletado_em, len(raw))
+dfc = _normalize_members_basic_cached(clientes_sig, raw)
 # Registra snapshot diário da quantidade de clientes
-try:
-    register_daily_client_count(len(dfc))
-except Exception as e:
-    st.warning("Não foi possível registrar o snapshot diário de clientes.")
-    st.exception(e)
+# (uma escrita por sessão/dia/total, não a cada rerun de filtro)
+_snapshot_key = (date.today(), len(dfc))
+if st.session_state.get("_daily_snapshot") != _snapshot_key:
+    try:
+        register_daily_client_count(len(dfc))
+    except Exception as e:
+        st.warning("Não foi possível registrar o snapshot diário de clientes.")
+        st.exception(e)
+    else:
+        st.session_state["_daily_snapshot"] = _snapshot_key
 # ──────────────────────────────────────────────────────────────────────────────
 # Sincroniza clientes + histórico de nível com o banco
 # ──────────────────────────────────────────────────────────────────────────────
@@ -738,24 +996,33 @@ colA, colB = st.columns(2)
 with colA:
     st.download_button(
         "⬇️ Baixar clientes (CSV — amigável)",
-        dfc.to_csv(index=False, encoding="utf-8-sig"),
+        _csv_bytes(dfc),
         "clientes_amigavel.csv",
         "text/csv",
     )
 with colB:
-    st.download_button(
+    _xlsx_sob_demanda(
+        dfc,
         "⬇️ Baixar clientes (XLSX — amigável)",
-        _excel_bytes(dfc, "Clientes"),
         "clientes_amigavel.xlsx",
-        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "Clientes",
+        key="_xlsx_clientes",
+        prep_label="📄 Preparar XLSX (amigável)",
     )
 
 st.divider()
 st.subheader("📦 Exportar base completa (bruta)")
 
-if st.button("Gerar CSV/XLSX bruto (todas as colunas)"):
+campos_brutos = st.multiselect(
+    "Campos de 1º nível a exportar (vazio = todos)",
+    _raw_top_keys(clientes_sig, raw),
+    default=[],
+    help="Menos campos = achatamento mais rápido e arquivo menor (ex.: sem memberships/contacts).",
+)
+
+if st.button("Gerar CSV/XLSX bruto (campos selecionados)"):
     with st.spinner("Achatar JSON completo…"):
-        df_full = pd.json_normalize(raw, sep="__")
+        df_full = _full_frame(clientes_sig, tuple(campos_brutos), raw)
         st.session_state["_clientes_full_df"] = df_full
         st.success(f"OK! Registros: {len(df_full)} • Colunas: {len(df_full.columns)}")
 
@@ -765,7 +1032,7 @@ if df_full is not None and not df_full.empty:
     with c1:
         st.download_button(
             "⬇️ Baixar clientes (CSV — completo/bruto)",
-            df_full.to_csv(index=False, encoding="utf-8-sig"),
+            _csv_bytes(df_full),
             "clientes_full_bruto.csv",
             "text/csv",
         )
@@ -783,7 +1050,7 @@ if df_full is not None and not df_full.empty:
 # ──────────────────────────────────────────────────────────────────────────────
 st.divider()
 
-st.caption(f"Atualizado em: {st.session_state.get('__last_updated__', '—')}")
+st.caption(f"Atualizado em: {coletado_em.strftime('%d/%m/%Y %H:%M')}")
 
 k1, k2, k3, k4 = st.columns(4)
 with k1:
@@ -805,7 +1072,10 @@ with colf0a:
     uf_series = dfc.get("UF", pd.Series(dtype=str)).dropna()
     sel_uf = st.multiselect("UF", sorted(uf_series.unique()), default=None)
 with colf0b:
-    termo = st.text_input("Buscar (nome, e-mail, telefone, ID)", "")
+    termo = st.text_input(
+        "Buscar (nome, e-mail, telefone, ID)", "", key="busca_clientes",
+        help="Mínimo de 2 caracteres.",
+    ).strip()
 
 colf1, colf2 = st.columns(2)
 with colf1:
@@ -824,31 +1094,30 @@ with colf4:
     if filtrar_data:
         dt_min = st.date_input("Criados a partir de", value=date.today())
 
-mask = pd.Series(True, index=dfc.index)
+# máscara em NumPy: cada filtro faz um AND in-place, sem alinhamento de índice
+mask = np.ones(len(dfc), dtype=bool)
 
-if sel_sexo:
-    mask &= dfc.get("Sexo", pd.Series(index=dfc.index)).isin(sel_sexo)
-if sel_cid:
-    mask &= dfc.get("Cidade", pd.Series(index=dfc.index)).isin(sel_cid)
-if sel_uf:
-    mask &= dfc.get("UF", pd.Series(index=dfc.index)).isin(sel_uf)
+for col, sel in (("Sexo", sel_sexo), ("Cidade", sel_cid), ("UF", sel_uf)):
+    if sel:
+        if col in dfc.columns:
+            mask &= dfc[col].isin(sel).to_numpy()
+        else:
+            mask[:] = False
 
 if "Idade" in dfc.columns and dfc["Idade"].notna().any():
-    mask &= dfc["Idade"].fillna(-1).between(faixa_idade[0], faixa_idade[1], inclusive="both")
+    mask &= dfc["Idade"].fillna(-1).between(faixa_idade[0], faixa_idade[1], inclusive="both").to_numpy()
 
 if "CriadoEm" in dfc.columns and dt_min:
-    mask &= pd.to_datetime(dfc["CriadoEm"], errors="coerce").dt.date >= dt_min
-
-if termo:
-    termo_low = termo.lower()
-    cols_busca = ["IdCliente", "Nome", "NomeLimpo", "Email", "Telefone"]
-    presentes = [c for c in cols_busca if c in dfc.columns]
-    if presentes:
-        mask &= dfc[presentes].astype(str).apply(
-            lambda s: s.str.lower().str.contains(termo_low, na=False)
-        ).any(axis=1)
-
-dfv = dfc[mask].copy()
+    mask &= _criado_dates(clientes_sig, dfc) >= np.datetime64(dt_min)
+
+# 1 caractere casa com quase toda a base: só filtra a partir de 2
+if len(termo) >= 2:
+    busca = _search_index(clientes_sig, dfc)
+    if busca is not None:
+        mask &= busca.str.contains(termo.lower(), regex=False, na=False).to_numpy(dtype=bool)
+
+# dfc/dfv são só leitura daqui pra baixo: sem .copy()
+dfv = dfc[mask]
 st.caption(f"Filtrados: {len(dfv)}")
 
 
@@ -858,17 +1127,22 @@ st.caption(f"Filtrados: {len(dfv)}")
 st.divider()
 st.subheader("📈 Evolução diária de clientes")
 
+@st.cache_data(show_spinner=False, ttl=300)
+def _daily_client_counts(snapshot_key):
+    # snapshot_key muda quando esta sessão registra um novo total → recarrega
+    df = load_daily_client_counts()
+    df["data"] = df["data"].dt.date
+    return df
+
+
 try:
-    df_daily = load_daily_client_counts()
+    df_daily = _daily_client_counts(st.session_state.get("_daily_snapshot"))
 except Exception as e:
     st.error("Não foi possível carregar o histórico diário de clientes.")
     st.exception(e)
     df_daily = None
 
 if df_daily is not None and not df_daily.empty:
-    df_daily = df_daily.copy()
-    df_daily["data"] = pd.to_datetime(df_daily["data"]).dt.date
-
     c_hist1, c_hist2 = st.columns(2)
 
     # 1) Número de clientes dia a dia (absoluto)
@@ -886,9 +1160,6 @@ if df_daily is not None and not df_daily.empty:
         )
         st.plotly_chart(fig_total, use_container_width=True)
 
-    # Garante que a coluna 'data' é data (sem horário)
-    df_daily["data"] = pd.to_datetime(df_daily["data"]).dt.date
-    
     # Define o corte
     data_corte = date(2025, 11, 30)
     
@@ -969,13 +1240,11 @@ if os.path.exists(GEO_PATH):
         and "IdCliente" in dfv.columns
         and "IdCliente" in df_geo.columns
     ):
-        # garante tipos compatíveis para merge
+        # garante tipos compatíveis para merge (IdCliente já vem str da normalização)
         df_geo["IdCliente"] = df_geo["IdCliente"].astype(str)
-        dfv_merge = dfv.copy()
-        dfv_merge["IdCliente"] = dfv_merge["IdCliente"].astype(str)
 
         # junta apenas clientes filtrados que têm lat/lon
-        df_map = dfv_merge.merge(
+        df_map = dfv.merge(
             df_geo[["IdCliente", "lat", "lon"]],
             on="IdCliente",
             how="inner",
@@ -1089,6 +1358,14 @@ else:
 # DETALHE DE UM CLIENTE ESPECÍFICO (substitui os gráficos)
 # ─────────────────────────────────────────────────────────────
 
+def _render_filtrados(df):
+    # tabela única (o ramo de cliente selecionado dá st.stop antes do fim da página);
+    # hide_index evita o reset_index, que copiava o dfv inteiro só para exibir
+    st.divider()
+    st.subheader("Dados (filtrados)")
+    st.dataframe(df, use_container_width=True, height=420, hide_index=True)
+
+
 selected_row = None
 if not dfv.empty:
     nomes_opcoes = ["(Nenhum)"] + sorted(dfv["Nome"].dropna().unique().tolist())
@@ -1144,39 +1421,53 @@ if selected_row is not None:
     else:
         st.info("Não foi possível identificar o ID deste cliente na EVO.")
 
-    st.divider()
-    st.subheader("Dados (filtrados)")
-    st.dataframe(dfv.reset_index(drop=True), use_container_width=True, height=420)
+    _render_filtrados(dfv)
 
     # IMPORTANTE: não desenha os gráficos gerais quando um cliente está selecionado
     st.stop()
 
 
+def _serie_sig(serie):
+    """Chave do cache das contagens: md5 dos hashes por linha, como em _df_signature."""
+    h = pd.util.hash_pandas_object(serie, index=False)
+    return len(serie), hashlib.md5(h.to_numpy().tobytes()).hexdigest()
+
+
+@st.cache_data(show_spinner=False, ttl=600, max_entries=64)
+def _contagem_por(col, serie_sig, _serie, com_pct=False):
+    """Clientes por valor de `col` (desc); com_pct adiciona % do total / % acumulado."""
+    # value_counts: um passe de hash já ordenado por contagem (sem groupby + sort)
+    cont = _serie.value_counts(sort=True).rename_axis(col).reset_index(name="Clientes")
+    if com_pct and len(cont):
+        c = cont["Clientes"].to_numpy()
+        pct = np.round(c * (100.0 / c.sum()), 1)
+        cont["% do total"] = pct
+        cont["% acumulado"] = np.round(np.cumsum(pct), 1)
+    return cont
+
+
 colE1, colE2 = st.columns(2)
 with colE1:
     st.download_button(
         "⬇️ Baixar filtrado (CSV — amigável)",
-        dfv.to_csv(index=False, encoding="utf-8-sig"),
+        _csv_bytes(dfv),
         "clientes_filtrado_amigavel.csv",
         "text/csv",
     )
 with colE2:
-    st.download_button(
+    _xlsx_sob_demanda(
+        dfv,
         "⬇️ Baixar filtrado (XLSX — amigável)",
-        _excel_bytes(dfv, "ClientesFiltrados"),
         "clientes_filtrado_amigavel.xlsx",
-        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "ClientesFiltrados",
+        key="_xlsx_filtrado",
+        prep_label="📄 Preparar XLSX (filtrado)",
     )
 
 gcols = st.columns(2)
 if "Sexo" in dfv.columns and not dfv.empty:
     with gcols[0]:
-        cont = (
-            dfv.groupby("Sexo", as_index=False)
-               .size()
-               .rename(columns={"size": "Clientes"})
-               .sort_values("Clientes", ascending=False)
-        )
+        cont = _contagem_por("Sexo", _serie_sig(dfv["Sexo"]), dfv["Sexo"])
 
         fig = px.pie(
             cont,
@@ -1205,39 +1496,17 @@ cols2 = st.columns(2)
 # TABELA DE BAIRROS (substitui o gráfico)
 if "Bairro" in dfv.columns and not dfv.empty:
     with cols2[0]:
-        df_bairros = (
-            dfv.groupby("Bairro", as_index=False)
-               .size()
-               .rename(columns={"size": "Clientes"})
-               .sort_values("Clientes", ascending=False)
-        )
-        total_clientes_bairros = df_bairros["Clientes"].sum()
-        df_bairros["% do total"] = (
-            df_bairros["Clientes"] / total_clientes_bairros * 100
-        ).round(1)
-        df_bairros["% acumulado"] = df_bairros["% do total"].cumsum().round(1)
+        df_bairros = _contagem_por("Bairro", _serie_sig(dfv["Bairro"]), dfv["Bairro"], com_pct=True)
 
         st.subheader("Bairros (todos)")
         st.dataframe(df_bairros, use_container_width=True)
 
 if "Cidade" in dfv.columns and not dfv.empty:
     with cols2[1]:
-        df_cidades = (
-            dfv.groupby("Cidade", as_index=False)
-               .size()
-               .rename(columns={"size": "Clientes"})
-               .sort_values("Clientes", ascending=False)
-        )
-        total_clientes_cidades = df_cidades["Clientes"].sum()
-        df_cidades["% do total"] = (
-            df_cidades["Clientes"] / total_clientes_cidades * 100
-        ).round(1)
-        df_cidades["% acumulado"] = df_cidades["% do total"].cumsum().round(1)
+        df_cidades = _contagem_por("Cidade", _serie_sig(dfv["Cidade"]), dfv["Cidade"], com_pct=True)
 
         st.subheader("Cidades (todas)")
         st.dataframe(df_cidades, use_container_width=True)
 
 
-st.divider()
-st.subheader("Dados (filtrados)")
-st.dataframe(dfv.reset_index(drop=True), use_container_width=True, height=420)
+_render_filtrados(dfv)
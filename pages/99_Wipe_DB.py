@@ -3,7 +3,7 @@
 import streamlit as st
 from pathlib import Path
 
-from db import restore_db_from_github, DB_PATH
+from db import restore_db_from_github, wipe_db, DB_PATH
 
 st.set_page_config(page_title="Manutenção do DB", page_icon="🧹", layout="centered")
 st.title("🧹 Manutenção do banco de dados (bts_clients.db)")
@@ -29,7 +29,7 @@ with tab_apagar:
 
     if st.button("🧹 APAGAR ARQUIVO data/bts_clients.db", type="primary"):
         if db_path.exists():
-            db_path.unlink()
+            wipe_db()
             st.success(
                 "Arquivo apagado com sucesso! Na próxima execução o DB será recriado do zero."
             )
@@ -0,0 +1,69 @@
+# tests/test_db_conexoes.py
+# threads de vida curta (como os reruns do Streamlit) não podem acumular conexões
+
+import threading
+
+import pytest
+
+pytest.importorskip("requests")
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    db._unlink_db_files()
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "bts_clients.db")
+    yield
+    db._unlink_db_files()
+
+
+def test_threads_curtas_reaproveitam_as_conexoes(banco):
+    def rerun(total):
+        db.register_daily_client_count(total)
+        db.load_daily_client_counts()
+
+    for i in range(50):
+        t = threading.Thread(target=rerun, args=(100 + i,))
+        t.start()
+        t.join()
+
+    assert set(db._CONNS) <= {"rw", "ro"}
+    df = db.load_daily_client_counts()
+    assert df["total_clientes"].tolist() == [149]
+
+
+def test_threads_concorrentes_gravam_sem_erro(banco):
+    erros = []
+
+    def rerun(total):
+        try:
+            db.register_daily_client_count(total)
+            db.load_daily_client_counts()
+        except Exception as e:  # pragma: no cover
+            erros.append(e)
+
+    threads = [threading.Thread(target=rerun, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert erros == []
+    assert len(db._CONNS) <= 2
+
+
+def test_leitura_nao_espera_transacao_de_escrita(banco):
+    db.register_daily_client_count(10)
+    lido = []
+
+    with db._shared_connection() as conn, conn:
+        conn.execute("UPDATE daily_clients SET total_clientes = 99;")
+        # outra thread lê pela conexão só de leitura com a escrita em aberto
+        t = threading.Thread(target=lambda: lido.append(db.load_daily_client_counts()))
+        t.start()
+        t.join(timeout=5)
+        assert not t.is_alive()
+
+    assert lido[0]["total_clientes"].tolist() == [10]
+    assert db.load_daily_client_counts()["total_clientes"].tolist() == [99]
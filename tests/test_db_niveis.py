@@ -0,0 +1,37 @@
+# tests/test_db_niveis.py
+# _extract_niveis (vetorizado) tem que bater com _extract_nome_e_nivel linha a linha
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("requests")
+
+import db  # noqa: E402
+
+
+def _esperado(nomes: pd.Series) -> list:
+    return [db._extract_nome_e_nivel(n)[1] for n in nomes]
+
+
+@pytest.mark.parametrize(
+    "valores, indice",
+    [
+        # nomes variados, índice padrão
+        (["DANIEL BRUNS 1B", "HENRIQUE 3A SB/2CSKI", "MARIA 1bsk", "JOÃO 2 C", "SEM NIVEL", "", "5E 9Z"], None),
+        # nenhum nome com nível
+        (["ANA", "BOB", "CARLOS 5X"], None),
+        # rótulos repetidos: cada linha fica com o próprio nível
+        (["ANA 1B", "BOB 2C"], [0, 0]),
+        (["ANA 1B", "SEM NIVEL", "BOB 4D 3A", "CAIO 2A"], ["x", "x", "y", "x"]),
+        # índice fora de ordem
+        (["ANA 1B", "BOB 2C", "CAIO"], [10, 3, 7]),
+        # vazio
+        ([], None),
+    ],
+)
+def test_extract_niveis_igual_ao_escalar(valores, indice):
+    nomes = pd.Series(valores, index=indice, dtype=object)
+    niveis = db._extract_niveis(nomes)
+
+    assert niveis.index.equals(nomes.index)
+    assert list(niveis) == _esperado(nomes)